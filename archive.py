@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import struct
+import sys
+
+import logparse
+import protocol
+
+# every kind of row is archived to DIR/<kind>/<YYYY-MM-DD>/<HH>.<writer>.lbc, one file per hour and writer.
+# a file is a sequence of blocks, each block holds the rows of one write column by column:
+# MAGIC, header length, json header {"rows", "codec", "columns": [[name, length], ...]}, then every column as a
+# compressed json list. <file>.idx is the json index of the file: min/max time and hosts of the file and of each
+# block, so scans skip whole files and blocks
+MAGIC = b'LBC1'
+BLOCK_HEADER = struct.Struct('!4sI')
+# kind: (columns, index of the time column, index of the host column)
+KINDS = {
+    'access': (logparse.LOG_COLUMNS, 0, 1),
+    'slow': (logparse.SLOW_COLUMNS, 8, 1),
+}
+# files and blocks with more hosts than this index no hosts and are never skipped by host
+MAX_INDEXED_HOSTS = 256
+
+
+def hour_path(directory, kind, time_text, writer):
+    return os.path.join(directory, kind, time_text[0:10], '%s.%s.lbc' % (time_text[11:13], writer))
+
+
+def load_index(path):
+    try:
+        with open(path + '.idx') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_index(path, index):
+    tmp_file = path + '.idx.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path + '.idx')
+
+
+def merge_hosts(hosts, more):
+    if hosts is None or more is None:
+        return None
+    hosts = sorted(set(hosts).union(more))
+    return hosts if len(hosts) <= MAX_INDEXED_HOSTS else None
+
+
+def encode_block(columns, rows, codec):
+    """
+    bytes of a block holding rows column by column, the caller adds its index entry
+    """
+    data = [protocol.compress(json.dumps([row[i] for row in rows], separators=(',', ':')).encode('utf-8'), codec)
+            for i in range(len(columns))]
+    header = json.dumps({'rows': len(rows), 'codec': codec,
+                         'columns': [[name, len(column)] for name, column in zip(columns, data)]}).encode('utf-8')
+    return BLOCK_HEADER.pack(MAGIC, len(header)) + header + b''.join(data)
+
+
+class ArchiveWriter:
+    """
+    appends rows to the hour files of one writer, only one thread may write at a time.
+    a block is on disk before the index lists it, blocks written after the last index update are cut off
+    by the next write to the file
+    """
+
+    def __init__(self, directory, writer, codec=protocol.CODEC_ZLIB):
+        self.directory = directory
+        self.writer = writer
+        self.codec = codec
+
+    def write(self, rows):
+        """
+        rows is {kind: [row tuple, ...]}, rows of a kind are grouped into one block per hour
+        """
+        for kind, kind_rows in rows.items():
+            columns, time_index, _ = KINDS[kind]
+            hours = {}
+            for row in kind_rows:
+                hours.setdefault(row[time_index][0:13], []).append(row)
+            for hour_rows in hours.values():
+                self.append(hour_path(self.directory, kind, hour_rows[0][time_index], self.writer), kind, hour_rows)
+
+    def append(self, path, kind, rows):
+        columns, time_index, host_index = KINDS[kind]
+        index = load_index(path)
+        if index is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            index = {'kind': kind, 'columns': columns, 'rows': 0, 'time': None, 'hosts': [], 'blocks': []}
+        end = index['blocks'][-1][0] + index['blocks'][-1][1] if len(index['blocks']) > 0 else 0
+        block = encode_block(columns, rows, self.codec)
+        times = [row[time_index] for row in rows]
+        hosts = merge_hosts([], {row[host_index] for row in rows})
+        with open(path, 'ab') as f:
+            # drop a block left over by a write that failed before its index update
+            f.truncate(end)
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        block_time = [min(times), max(times)]
+        index['blocks'].append([end, len(block), len(rows), block_time, hosts])
+        index['rows'] += len(rows)
+        index['time'] = block_time if index['time'] is None else [min(index['time'][0], block_time[0]),
+                                                                   max(index['time'][1], block_time[1])]
+        index['hosts'] = merge_hosts(index['hosts'], hosts)
+        save_index(path, index)
+
+
+def overlaps(time_range, start, end):
+    return (start is None or time_range[1] >= start) and (end is None or time_range[0] < end)
+
+
+def read_block(f, offset, names):
+    """
+    {column name: values} of the named columns of the block at offset, the other columns are not decompressed
+    """
+    f.seek(offset)
+    magic, header_length = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('bad block at %d of %s' % (offset, f.name))
+    header = json.loads(f.read(header_length))
+    position = offset + BLOCK_HEADER.size + header_length
+    values = {}
+    for name, length in header['columns']:
+        if name in names:
+            f.seek(position)
+            values[name] = json.loads(protocol.decompress(f.read(length), header['codec']))
+        position += length
+    return values
+
+
+def scan(directory, kind, start=None, end=None, host=None, columns=None):
+    """
+    yield the rows with start <= time < end (times as 'YYYY-MM-DD HH:MM:SS' prefixes) and the given host as tuples
+    of columns, all columns by default. files and blocks outside the range or without the host are not read
+    """
+    all_columns, time_index, host_index = KINDS[kind]
+    columns = tuple(columns or all_columns)
+    names = set(columns) | {all_columns[time_index], all_columns[host_index]}
+    kind_directory = os.path.join(directory, kind)
+    if not os.path.isdir(kind_directory):
+        return
+    for day in sorted(os.listdir(kind_directory)):
+        if (start is not None and day < start[0:10]) or (end is not None and day > end[0:10]):
+            continue
+        for file in sorted(os.listdir(os.path.join(kind_directory, day))):
+            if not file.endswith('.lbc'):
+                continue
+            path = os.path.join(kind_directory, day, file)
+            index = load_index(path)
+            if index is None or not overlaps(index['time'], start, end):
+                continue
+            if host is not None and index['hosts'] is not None and host not in index['hosts']:
+                continue
+            with open(path, 'rb') as f:
+                for offset, _, _, block_time, block_hosts in index['blocks']:
+                    if not overlaps(block_time, start, end):
+                        continue
+                    if host is not None and block_hosts is not None and host not in block_hosts:
+                        continue
+                    values = read_block(f, offset, names)
+                    times = values[all_columns[time_index]]
+                    hosts = values[all_columns[host_index]]
+                    for i in range(len(times)):
+                        if (start is not None and times[i] < start) or (end is not None and times[i] >= end):
+                            continue
+                        if host is not None and hosts[i] != host:
+                            continue
+                        yield tuple(values[name][i] for name in columns)
+
+
+if __name__ == '__main__':
+    '''
+    print archived rows as tab separated columns
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='ARCHIVE_DIR of the server')
+    parser.add_argument('kind', choices=sorted(KINDS))
+    parser.add_argument('--start', help="first time, e.g. '2022-08-09 07:00'")
+    parser.add_argument('--end', help='time after the last row')
+    parser.add_argument('--host')
+    parser.add_argument('--columns', help='comma separated columns, all by default')
+    args = parser.parse_args()
+    for archived in scan(args.directory, args.kind, args.start, args.end, args.host,
+                         args.columns.split(',') if args.columns else None):
+        sys.stdout.write('\t'.join(str(value) for value in archived) + '\n')
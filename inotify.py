@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+FILE_MASK = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+DIR_MASK = IN_CREATE | IN_MOVED_TO
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        wait up to timeout seconds, return [(wd, mask, name)]
+        """
+        if not self.poller.poll(timeout * 1000):
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0').decode(errors='ignore')
+            pos += name_len
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TailNotifier:
+    """
+    track which watched files changed since they were last read to EOF.
+    watch/unwatch are called from the event loop, wait from the reader thread
+    """
+
+    def __init__(self):
+        self.inotify = Inotify()
+        self.lock = threading.Lock()
+        self.files = {}
+        self.dirs = {}
+        self.names = {}
+        self.dirty = set()
+
+    def watch(self, key, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            try:
+                self.files[self.inotify.add_watch(path, FILE_MASK)] = key
+                dirname, basename = os.path.split(path)
+                self.dirs[self.inotify.add_watch(dirname, DIR_MASK)] = dirname
+                self.names[(dirname, basename)] = key
+            except OSError as e:
+                logging.warning('inotify watch %s failed: %s', path, repr(e))
+            self.dirty.add(key)
+
+    def unwatch(self, key):
+        with self.lock:
+            for wd in [wd for wd, file_key in self.files.items() if file_key == key]:
+                del self.files[wd]
+                self.inotify.rm_watch(wd)
+            for name in [name for name, file_key in self.names.items() if file_key == key]:
+                del self.names[name]
+            self.dirty.discard(key)
+
+    def is_dirty(self, key):
+        return key in self.dirty
+
+    def clean(self, key):
+        with self.lock:
+            self.dirty.discard(key)
+
+    def wait(self, timeout):
+        """
+        block until a watched file changes or timeout seconds pass
+        """
+        for wd, mask, name in self.inotify.read(timeout):
+            with self.lock:
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, any file may have changed
+                    self.dirty.update(self.files.values())
+                    self.dirty.update(self.names.values())
+                elif wd in self.files:
+                    self.dirty.add(self.files[wd])
+                    if mask & IN_IGNORED:
+                        del self.files[wd]
+                elif wd in self.dirs and (self.dirs[wd], name) in self.names:
+                    self.dirty.add(self.names[(self.dirs[wd], name)])
+
+
+def create(mode=None):
+    """
+    mode: auto (inotify when available), inotify or poll. return None to fall back to polling
+    """
+    mode = (mode or 'auto').lower()
+    if mode == 'poll':
+        return None
+    if not sys.platform.startswith('linux'):
+        if mode == 'inotify':
+            logging.warning('inotify is only available on linux, fall back to polling')
+        return None
+    try:
+        return TailNotifier()
+    except (OSError, AttributeError) as e:
+        logging.warning('inotify unavailable, fall back to polling: %s', repr(e))
+        return None
@@ -1,92 +1,255 @@
 #!/usr/bin/env python3
 import asyncio
+import collections
 import concurrent.futures
+import glob
 import logging
 import os
 import signal
 import threading
 import time
 
-import websockets
 from dotenv import dotenv_values
 
+import inotify
+import metrics
+import rules
+import shipper
+import tailer
 import utils
 
 watch_files = []
+# inodes of the rotated logs drained and closed, their new names matching WATCH_LOG are not watched again
+drained_inodes = set()
 read_lock = threading.Lock()
+inflight = collections.OrderedDict()
+rule_set = None
 
+read_bytes_total = metrics.Counter('logbeat_read_bytes_total', 'bytes of complete lines read from the logs')
+read_seconds = metrics.Histogram('logbeat_read_seconds', 'seconds of a round reading the changed files')
 
-async def send_log(queue):
-    uri = "ws://" + config['WS_USER'] + ':' + config['WS_PASS'] + '@' + config['WS_HOST'] + ':' + config['WS_PORT']
-    async for websocket in websockets.connect(uri):
+
+def tail_lag():
+    lags = {}
+    # no read_lock, a scrape must not wait for a read round
+    for log_tailer in list(watch_files):
         try:
-            while websocket.open:
-                log = await queue.get()
-                await websocket.send(log)
-                # TODO: receive response to confirm especially when server restart
-                queue.task_done()
-        except websockets.ConnectionClosed:
-            continue
-        except Exception as e:
-            logging.warning(repr(e), exc_info=True)
+            # a rotated file being drained counts towards its path
+            lags[(log_tailer.name,)] = lags.get((log_tailer.name,), 0) + log_tailer.lag()
+        except (OSError, ValueError):
+            pass
+    return lags
+
+
+def rule_counts(index):
+    if rule_set is None:
+        return {}
+    return {(name, ): counts[index] for name, counts in rule_set.stats().items()}
+
+
+metrics.Gauge('logbeat_tail_lag_bytes', 'bytes written to a log and not read yet', labels=('file',), function=tail_lag)
+metrics.Counter('logbeat_rule_hits_total', 'lines matching a rule', labels=('rule',), function=lambda: rule_counts(0))
+metrics.Counter('logbeat_rule_dropped_total', 'lines dropped by a rule', labels=('rule',),
+                function=lambda: rule_counts(1))
+
+
+async def send_log(queue):
+    await shipper.send_log(shipper.endpoint_uris(config), queue, checkpoint, config, inflight)
 
 
 async def add_log(queue):
     loop = asyncio.get_running_loop()
-    with concurrent.futures.ThreadPoolExecutor() as pool:
+    read_pool = concurrent.futures.ThreadPoolExecutor(int(config.get('TAIL_WORKERS') or 4))
+    with concurrent.futures.ThreadPoolExecutor(1) as pool, read_pool:
         while True:
-            result = await loop.run_in_executor(pool, watch_log)
+            result = await loop.run_in_executor(pool, watch_log, read_pool)
             for log in result:
                 await queue.put(log)
 
 
-def watch_log():
-    start_time = time.time()
-    result = []
+def watch_log(read_pool):
+    """
+    one round over the changed files, read in parallel on read_pool. each file stops after tailer_file_budget
+    bytes per round so a busy log does not hold back the others, what is left is read in the next rounds
+    """
+    started = time.time()
     with read_lock:
-        for fp in watch_files:
-            while fp.readable():
-                line = fp.readline()
-                if line:
-                    result.append(line)
-                    if len(result) >= 20:
-                        return result
-                else:
-                    break
-            else:
-                logging.warning('not readable: %s', fp.name)
-    if time.time() - start_time < 1:
-        time.sleep(1)
+        result = follow_rotations()
+        log_tailers = [log_tailer for log_tailer in watch_files
+                       if notifier is None or notifier.is_dirty(log_tailer)]
+        result.extend(log for logs in read_pool.map(read_file, log_tailers) for log in logs)
+    if len(log_tailers) > 0:
+        read_seconds.observe(time.time() - started)
+    if len(result) == 0:
+        if notifier is not None:
+            notifier.wait(1)
+        else:
+            time.sleep(1)
     return result
 
 
-def log_rotate(queue):
-    with read_lock:
-        finial_logs = close_open_files(True)
-    open_files(False)
-    if len(finial_logs) > 0:
-        asyncio.create_task(add_finial_log(finial_logs, queue))
+def read_file(log_tailer):
+    result = []
+    read_bytes = 0
+    while read_bytes < tailer_file_budget:
+        chunk = log_tailer.read()
+        if not chunk:
+            if notifier is not None:
+                notifier.clean(log_tailer)
+            break
+        read_bytes += len(chunk)
+        read_bytes_total.inc(len(chunk))
+        if rule_set is not None:
+            chunk = rule_set.filter(chunk)
+            if not chunk:
+                # the checkpoint moves past the dropped lines with the next chunk kept
+                continue
+        result.append((chunk, log_tailer.mark()))
+    return result
+
+
+def follow_rotations():
+    """
+    runs in the reader thread with read_lock held. a log whose path was renamed or removed keeps being read like
+    the others for TAIL_ROTATE_GRACE seconds, while its writer may still append to it, and is closed once read to
+    the end; a new file at its path is watched from its start. a log truncated in place (copytruncate) is read
+    again from its start. return the last partial lines of the closed logs
+    """
+    now = time.time()
+    result = []
+    for log_tailer in list(watch_files):
+        if log_tailer.rotated_at is not None:
+            continue
+        rotation = log_tailer.rotation()
+        if rotation == 'truncated':
+            # lines written between the last read and the truncation only went to the copy
+            logging.warning('%s was truncated at %d bytes read, read it from the start',
+                            log_tailer.name, log_tailer.offset)
+            log_tailer.seek(0)
+        elif rotation == 'moved':
+            logging.info('%s was rotated, drain it', log_tailer.name)
+            log_tailer.rotated_at = now
+    watched = {log_tailer.name for log_tailer in watch_files if log_tailer.rotated_at is None}
+    for log_tailer in list(watch_files):
+        if log_tailer.rotated_at is None:
+            continue
+        if log_tailer.name not in watched and os.path.isfile(log_tailer.name):
+            try:
+                watch_file(log_tailer.name)
+                watched.add(log_tailer.name)
+            except OSError as e:
+                logging.warning('open log failed: ' + repr(e))
+        if now - log_tailer.rotated_at >= tail_rotate_grace and log_tailer.at_end():
+            chunk = log_tailer.flush()
+            if chunk:
+                result.append((chunk, None))
+            logging.info('finished draining rotated %s', log_tailer.name)
+            drained_inodes.add(log_tailer.ino)
+            unwatch_file(log_tailer)
+    return result
+
 
+def watch_paths():
+    """
+    expand the glob patterns of WATCH_LOG
+    """
+    paths = []
+    for pattern in config['WATCH_LOG'].split():
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
 
-async def add_finial_log(finial_logs, queue):
-    for log in finial_logs:
-        await queue.put(log)
+
+def new_paths():
+    """
+    the files matching WATCH_LOG that are not watched yet, by path or by inode. a rotated log renamed to a matching
+    name (access.log -> access-2022-08-09.log) is the file already read under its old name, being drained or
+    drained and closed, and is left out. runs with read_lock held
+    """
+    watched = {log_tailer.name for log_tailer in watch_files}
+    inodes = {log_tailer.ino for log_tailer in watch_files}
+    matched = set()
+    paths = []
+    for path in watch_paths():
+        if not os.path.isfile(path):
+            continue
+        try:
+            ino = os.stat(path).st_ino
+        except FileNotFoundError:
+            continue
+        matched.add(ino)
+        if path not in watched and ino not in inodes and ino not in drained_inodes:
+            paths.append(path)
+    # the inode of a removed log may be reused by a new file
+    drained_inodes.intersection_update(matched)
+    return paths
+
+
+async def rescan_files():
+    """
+    watch the files newly matching WATCH_LOG from their start and report the files lagging behind their writers,
+    removed files are drained and closed by follow_rotations
+    """
+    interval = float(config.get('WATCH_RESCAN') or 10)
+    lag_warning = int(config.get('TAIL_LAG_WARNING') or 64 << 20)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with read_lock:
+                paths = new_paths()
+                for path in paths:
+                    watch_file(path)
+            for path in paths:
+                logging.info('start watching new log %s', path)
+            for log_tailer in list(watch_files):
+                lag = log_tailer.lag()
+                if lag >= lag_warning:
+                    logging.warning('%s lags %d bytes behind', log_tailer.name, lag)
+        except Exception as e:
+            logging.warning(repr(e), exc_info=True)
+
+
+def log_rotate():
+    # kept so that the SIGUSR1 of existing logrotate configs does not terminate the client
+    logging.info('SIGUSR1 is not needed any more, rotations are detected by the tailer')
+
+
+def log_rule_stats():
+    if rule_set is not None:
+        for name, (hits, dropped) in rule_set.stats().items():
+            logging.info('rule %s: %d hits, %d dropped', name, hits, dropped)
 
 
 def update_watch():
+    global rule_set
+    if config.get('RULES_FILE'):
+        log_rule_stats()
+        # invalid rules leave the loaded ones in place
+        rule_set = rules.load(config['RULES_FILE']) or rule_set
     with read_lock:
         offset_dict = close_open_files(save_offset=True)
     open_files(seek=True, offset_dict=offset_dict)
 
 
+def queue_gauges(queue):
+    metrics.Gauge('logbeat_queue_items', 'chunks waiting to be sent', function=queue.qsize)
+    metrics.Gauge('logbeat_inflight_batches', 'batches sent and not acknowledged yet', function=lambda: len(inflight))
+    if isinstance(queue, shipper.SpillQueue):
+        metrics.Gauge('logbeat_spill_bytes', 'bytes of segment files in the spill directory',
+                      function=lambda: queue.disk_bytes)
+
+
 async def client():
-    open_files(True)
-    g_queue = asyncio.Queue(maxsize=10000)
+    g_queue = shipper.create_queue(config.get('SPILL_DIR'), config)
+    open_files(True, shipper.spilled_offsets(g_queue))
+    queue_gauges(g_queue)
+    metrics_server = await metrics.serve(config.get('METRICS_HOST'), config.get('METRICS_PORT'))
     watch_task = asyncio.create_task(add_log(g_queue))
     send_task = asyncio.create_task(send_log(g_queue))
+    rescan_task = asyncio.create_task(rescan_files())
     loop = asyncio.get_running_loop()
     loop.add_signal_handler(signal.SIGTERM, watch_task.cancel)
-    loop.add_signal_handler(signal.SIGUSR1, log_rotate, g_queue)
+    loop.add_signal_handler(signal.SIGUSR1, log_rotate)
     loop.add_signal_handler(signal.SIGUSR2, update_watch)
     try:
         await asyncio.gather(*[watch_task, send_task])
@@ -96,53 +259,73 @@ async def client():
         logging.warning(repr(e), exc_info=True)
         watch_task.cancel()
     finally:
-        await g_queue.join()
-        send_task.cancel()
+        rescan_task.cancel()
+        await shipper.shutdown(g_queue, send_task, inflight, float(config.get('SHUTDOWN_TIMEOUT') or 10))
         close_open_files()
+        if metrics_server is not None:
+            metrics_server.close()
+        log_rule_stats()
 
 
 def open_files(seek=False, offset_dict=None):
-    if offset_dict is None:
-        offset_dict = {}
-    try:
-        offset_ino = offset_dict.keys()
-        for file in config['WATCH_LOG'].split(' '):
-            log_fp = open(file, errors='ignore')
-            if log_fp.readable():
-                if seek or len(offset_dict) > 0:
-                    stat = os.stat(file)
-                    if stat.st_ino in offset_ino:
-                        log_fp.seek(offset_dict[stat.st_ino])
-                    elif seek:
-                        log_fp.seek(stat[6])
-                watch_files.append(log_fp)
-    except Exception as e:
-        logging.warning('open log failed: ' + repr(e))
+    for file in new_paths():
+        try:
+            watch_file(file, seek, offset_dict)
+        except Exception as e:
+            logging.warning('open log failed: ' + repr(e))
     if len(watch_files) == 0:
         logging.warning('no available watch log')
         exit(0)
 
 
-def close_open_files(read_finial=False, save_offset=False):
-    finial_lines = []
+def watch_file(file, seek=False, offset_dict=None):
+    log_tailer = tailer.FileTailer(file, tailer_chunk_size)
+    size = log_tailer.size()
+    acked_offset = checkpoint.get(file, log_tailer.ino)
+    if offset_dict is not None and log_tailer.ino in offset_dict and offset_dict[log_tailer.ino] <= size:
+        log_tailer.seek(offset_dict[log_tailer.ino])
+    elif acked_offset is not None and acked_offset <= size:
+        log_tailer.seek(acked_offset)
+    elif seek:
+        log_tailer.seek(size)
+    watch_files.append(log_tailer)
+    if notifier is not None:
+        notifier.watch(log_tailer, file)
+
+
+def unwatch_file(log_tailer):
+    if notifier is not None:
+        notifier.unwatch(log_tailer)
+    log_tailer.close()
+    watch_files.remove(log_tailer)
+
+
+def close_open_files(save_offset=False):
+    """
+    close every log, return {inode: offset} when save_offset. when reopening with save_offset the rotated logs
+    are left open to finish draining
+    """
     offset_dict = {}
-    for fp in watch_files:
-        if fp.readable():
-            if read_finial:
-                finial_lines.extend(fp.readlines())
-            if save_offset:
-                offset_dict[os.stat(fp.name).st_ino] = fp.tell()
-            fp.close()
-            watch_files.remove(fp)
-    if save_offset:
-        return offset_dict
-    return finial_lines
+    for log_tailer in list(watch_files):
+        if save_offset:
+            if log_tailer.rotated_at is not None:
+                continue
+            offset_dict[log_tailer.ino] = log_tailer.offset
+        unwatch_file(log_tailer)
+    return offset_dict
 
 
 if __name__ == '__main__':
     '''
     scan log to queue, then send log
     '''
-    config = dotenv_values()
+    # LOGBEAT_ENV selects another env file than .env, e.g. for the benchmark
+    config = dotenv_values(os.environ.get('LOGBEAT_ENV'))
     utils.init_logger(config['LOG_FILE'], config['LOG_LEVEL'])
+    checkpoint = shipper.Checkpoint(config.get('CHECKPOINT_FILE') or 'logs/checkpoint.json')
+    notifier = inotify.create(config.get('TAIL_MODE'))
+    tailer_chunk_size = int(config.get('TAIL_CHUNK_BYTES') or tailer.CHUNK_SIZE)
+    tailer_file_budget = int(config.get('TAIL_FILE_BUDGET') or tailer_chunk_size)
+    tail_rotate_grace = float(config.get('TAIL_ROTATE_GRACE') or 5)
+    rule_set = rules.load(config.get('RULES_FILE'))
     asyncio.run(client())
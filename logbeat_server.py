@@ -1,57 +1,539 @@
 #!/usr/bin/env python3
 import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import datetime
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
 import signal
+import socket
+import tempfile
 import time
-from hashlib import sha256
 
 import aiomysql
+import pymysql
 import websockets
 from dotenv import dotenv_values
 
+import archive
+import logparse
+import metrics
+import protocol
+import recent
+import rollup
 import utils
 
-existed_tables = []
+existed_tables = set()
+indexed_tables = set()
+partition_table = None
 lock = asyncio.Lock()
+# the sinks every parsed frame is written to
+sinks = []
+load_data = False
+parse_pool = None
+parse_workers = 0
+parse_backlog = 1
+rollups = None
+rollup_table = None
+pending_rollups = []
+# index of this process among the SERVER_WORKERS workers, worker 0 maintains the tables
+worker_index = 0
+# the last RECENT_ROWS access log rows for /query and /tail, None when RECENT_ROWS is 0
+recent_rows = None
 
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+# ER_NOT_ALLOWED_COMMAND, CR_LOAD_DATA_LOCAL_INFILE_REJECTED, ER_CLIENT_LOCAL_FILES_DISABLED
+LOCAL_INFILE_DISABLED = (1148, 2068, 3948)
+# WARN_DATA_TRUNCATED, ER_WARN_DATA_OUT_OF_RANGE, ER_TRUNCATED_WRONG_VALUE, ER_TRUNCATED_WRONG_VALUE_FOR_FIELD,
+# ER_DATA_TOO_LONG: rows strict sql_mode rejects
+DATA_ERRORS = (1265, 1264, 1292, 1366, 1406)
+# seconds to wait for another worker or server holding the DDL lock
+DDL_LOCK_TIMEOUT = 60
+SLOW_DIGEST_COLUMNS = ('fingerprint_hash', 'fingerprint', 'sample', 'count', 'query_time_total', 'query_time_max',
+                       'lock_time_total', 'rows_sent_total', 'rows_examined_total', 'rows_examined_max', 'first_seen',
+                       'last_seen')
+frames_received = metrics.Counter('logbeat_frames_received_total', 'websocket frames received')
+bytes_received = metrics.Counter('logbeat_received_bytes_total', 'bytes of websocket frames received')
+rows_parsed = metrics.Counter('logbeat_rows_parsed_total', 'rows parsed from lines or decoded from rows frames')
+parse_errors = metrics.Counter('logbeat_parse_errors_total', 'log lines that failed to parse')
+parse_seconds = metrics.Histogram('logbeat_parse_seconds', 'seconds from receiving a frame to its parsed rows')
+queue_wait_seconds = metrics.Histogram('logbeat_queue_wait_seconds', 'seconds a frame waits in a sink queue')
+sink_rows = metrics.Counter('logbeat_sink_rows_total', 'rows written by a sink', labels=('sink',))
+sink_failures = metrics.Counter('logbeat_sink_failures_total', 'failed writes of a sink', labels=('sink',))
+rows_inserted = metrics.Counter('logbeat_rows_inserted_total', 'rows committed to MySQL')
+insert_failures = metrics.Counter('logbeat_insert_failures_total', 'failed insert transactions')
+rows_rejected = metrics.Counter('logbeat_rows_rejected_total', 'rows MySQL rejected, logged and left out')
+insert_seconds = metrics.Histogram('logbeat_insert_seconds', 'seconds of an insert transaction')
+create_table_seconds = metrics.Histogram('logbeat_create_table_seconds', 'seconds to create a table')
+connections = metrics.Gauge('logbeat_connections', 'open websocket connections')
+metrics.Gauge('logbeat_recent_rows', 'access log rows kept for /query and /tail',
+              function=lambda: len(recent_rows) if recent_rows is not None else 0)
+metrics.Gauge('logbeat_tail_subscribers', 'open /tail connections',
+              function=lambda: len(recent_rows.subscribers) if recent_rows is not None else 0)
+ingest_queue_frames = metrics.Gauge('logbeat_ingest_queue_frames', 'frames waiting for the writers of a sink',
+                                    labels=('sink',),
+                                    function=lambda: {(sink.name,): sink.queue.qsize() for sink in sinks})
+# secondary indexes (name, columns) of the access log and slow log tables per INDEX_PROFILE
+INDEX_PROFILES = {
+    'none': {'log': (), 'slow': ()},
+    'dashboard': {
+        'log': (('idx_time', 'time'), ('idx_host_time', 'host, time'), ('idx_status_time', 'status, time'),
+                ('idx_uri_time', 'request_uri, time')),
+        'slow': (('idx_time', 'time'), ('idx_query_time', 'query_time')),
+    },
+    # wider indexes that also cover the columns the dashboards aggregate, so those queries skip the rows
+    'covering': {
+        'log': (('idx_time', 'time'), ('idx_host_time', 'host, time, status, request_time'),
+                ('idx_status_time', 'status, time, host'),
+                ('idx_uri_time', 'request_uri, time, request_time, upstream_response_time')),
+        'slow': (('idx_time', 'time, query_time'), ('idx_query_time', 'query_time')),
+    },
+}
 
-async def log_insert(pool, row):
-    if not isinstance(row, dict):
-        return False
-    row_month = row['time'][0:7].replace('-', '')
+
+class NullCursor:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, sql, args=None):
+        pass
+
+    async def executemany(self, sql, args):
+        pass
+
+    async def fetchall(self):
+        return ()
+
+
+class NullConnection:
+    def cursor(self):
+        return NullCursor()
+
+    async def commit(self):
+        pass
+
+
+class NullPool:
+    """
+    WRITE_MODE=null: accepts every statement and writes nothing, to benchmark everything but MySQL
+    """
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield NullConnection()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def insert_sql(table, columns):
+    return "INSERT INTO " + table + "(" + ", ".join(columns) + ") VALUES (" + ", ".join(["%s"] * len(columns)) + ")"
+
+
+def load_data_sql(table, columns):
+    return "LOAD DATA LOCAL INFILE %s INTO TABLE " + table + " CHARACTER SET utf8mb4 (" + ", ".join(columns) + ")"
+
+
+def write_tsv(rows):
+    """
+    spool rows into a temporary file in the default LOAD DATA format: tab separated fields,
+    '\n' terminated lines and backslash escapes
+    """
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.tsv', dir=config.get('LOAD_DATA_DIR') or None,
+                                     delete=False) as f:
+        for row in rows:
+            f.write('\t'.join(str(value).translate(TSV_ESCAPES) for value in row))
+            f.write('\n')
+        return f.name
+
+
+async def insert_rows(cursor, table, columns, rows):
+    """
+    LOAD DATA LOCAL INFILE in load mode, falls back to INSERT for good when local_infile is disabled
+    """
+    global load_data
+    if load_data:
+        loop = asyncio.get_running_loop()
+        tsv_file = await loop.run_in_executor(None, write_tsv, rows)
+        try:
+            await cursor.execute(load_data_sql(table, columns), (tsv_file,))
+            return
+        except pymysql.MySQLError as e:
+            if e.args[0] not in LOCAL_INFILE_DISABLED:
+                raise
+            logging.warning('LOAD DATA LOCAL INFILE is not allowed, fall back to INSERT: %s', repr(e))
+            load_data = False
+        finally:
+            os.unlink(tsv_file)
+    # executemany rewrites "INSERT ... VALUES (...)" into multi-row VALUES statements
+    await cursor.executemany(insert_sql(table, columns), rows)
+
+
+async def log_table(pool, row):
+    if partition_table is not None:
+        # daily partitions are created ahead of time by maintain_partitions
+        return partition_table
+    row_month = row[0][0:7].replace('-', '')
     row_table = config['DB_PREFIX'] + row_month
     if row_table not in existed_tables:
         async with lock:
             if row_table not in existed_tables:
+                started = time.time()
                 created_table = await create_table(pool, row_month)
-                existed_tables.append(created_table)
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            sql = "INSERT INTO " + row_table + "(time, host, client_ip, request_uri, request_query, request_version, " \
-                                               "request_method, status, size, upstream_time, upstream_addr, " \
-                                               "upstream_status, upstream_response_time, request_time, " \
-                                               "connection_time, http_referer, user_agent, x_forwarded_for, " \
-                                               "sess_tag) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, " \
-                                               "%s, %s, %s, %s, %s, %s)"
-            await cursor.execute(sql, tuple(row.values()))
-        await conn.commit()
+                create_table_seconds.observe(time.time() - started)
+                existed_tables.add(created_table)
+    return row_table
+
+
+def slow_digest_sql():
+    # sample is assigned before query_time_max, the assignments see the values updated before them
+    return insert_sql('mysql_slow_digest', SLOW_DIGEST_COLUMNS) + \
+        " ON DUPLICATE KEY UPDATE sample=IF(VALUES(query_time_max) > query_time_max, VALUES(sample), sample), " \
+        "count=count+VALUES(count), query_time_total=query_time_total+VALUES(query_time_total), " \
+        "query_time_max=GREATEST(query_time_max, VALUES(query_time_max)), " \
+        "lock_time_total=lock_time_total+VALUES(lock_time_total), " \
+        "rows_sent_total=rows_sent_total+VALUES(rows_sent_total), " \
+        "rows_examined_total=rows_examined_total+VALUES(rows_examined_total), " \
+        "rows_examined_max=GREATEST(rows_examined_max, VALUES(rows_examined_max)), " \
+        "first_seen=LEAST(first_seen, VALUES(first_seen)), last_seen=GREATEST(last_seen, VALUES(last_seen))"
+
+
+def slow_digest_rows(rows):
+    """
+    aggregate slow log rows per fingerprint into SLOW_DIGEST_COLUMNS rows, the slowest query is the sample
+    """
+    digests = {}
+    for _, _, _, query_time, lock_time, rows_sent, rows_examined, content, row_time, fingerprint_hash in rows:
+        query_time = float(query_time)
+        rows_examined = int(rows_examined)
+        digest = digests.get(fingerprint_hash)
+        if digest is None:
+            digests[fingerprint_hash] = [fingerprint_hash, logparse.fingerprint(content), content, 1, query_time,
+                                         query_time, float(lock_time), int(rows_sent), rows_examined, rows_examined,
+                                         row_time, row_time]
+            continue
+        if query_time > digest[5]:
+            digest[2] = content
+            digest[5] = query_time
+        digest[3] += 1
+        digest[4] += query_time
+        digest[6] += float(lock_time)
+        digest[7] += int(rows_sent)
+        digest[8] += rows_examined
+        digest[9] = max(digest[9], rows_examined)
+        digest[10] = min(digest[10], row_time)
+        digest[11] = max(digest[11], row_time)
+    for digest in digests.values():
+        digest[4] = round(digest[4], 6)
+        digest[6] = round(digest[6], 6)
+    # writers upserting the same fingerprints lock their rows in the same order and cannot deadlock
+    return [tuple(digests[fingerprint_hash]) for fingerprint_hash in sorted(digests)]
 
 
-async def slow_log_insert(pool, row):
-    if not isinstance(row, dict):
-        return False
+async def slow_log_table(pool):
     if 'mysql_slow' not in existed_tables:
         async with lock:
             if 'mysql_slow' not in existed_tables:
+                started = time.time()
                 created_table = await create_slow_table(pool)
-                existed_tables.append(created_table)
+                create_table_seconds.observe(time.time() - started)
+                existed_tables.add(created_table)
+    return 'mysql_slow'
+
+
+class Sink:
+    """
+    a destination of the parsed rows with its own bounded queue and writer tasks, so a slow sink only holds back
+    the frames it has not written yet. queue items are (rows, row_count, committed, enqueued time) where rows is
+    {'access' or 'slow': [row tuple, ...]}, the writers resolve committed with True once the rows are written
+    and with False if writing them failed. a sink runs writer_count tasks of its write coroutine
+    """
+    name = None
+    writer_count = 1
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.write()) for _ in range(self.writer_count)]
+
+    async def put(self, rows, row_count):
+        """
+        blocks while the queue is full, return the committed future of the rows
+        """
+        loop = asyncio.get_running_loop()
+        committed = loop.create_future()
+        await self.queue.put((rows, row_count, committed, loop.time()))
+        return committed
+
+    def done(self, batch, committed):
+        """
+        committed holds True or False for every frame of the batch
+        """
+        sink_rows.inc(sum(item[1] for item, ok in zip(batch, committed) if ok), labels=(self.name,))
+        if not all(committed):
+            sink_failures.inc(labels=(self.name,))
+        for (_, _, future, _), ok in zip(batch, committed):
+            # send_ack cancels the future it waits on when the connection closed meanwhile
+            if not future.cancelled():
+                future.set_result(ok)
+            self.queue.task_done()
+
+    async def stop(self):
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+
+
+class MySQLSink(Sink):
+    """
+    writes the rows to the monthly, partitioned and slow log tables with writer_count write_rows tasks
+    """
+    name = 'mysql'
+
+    def __init__(self, queue_size, pool, writer_count):
+        super().__init__(queue_size)
+        self.pool = pool
+        self.writer_count = writer_count
+
+    async def write(self):
+        await write_rows(self.pool, self)
+
+
+class ArchiveSink(Sink):
+    """
+    appends the rows to the hourly column files of archive.py in a thread, one block per kind and hour every
+    ARCHIVE_INTERVAL seconds or ARCHIVE_BLOCK_ROWS rows
+    """
+    name = 'archive'
+
+    def __init__(self, queue_size, writer):
+        super().__init__(queue_size)
+        self.writer = writer
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def write(self):
+        loop = asyncio.get_running_loop()
+        block_rows = int(config.get('ARCHIVE_BLOCK_ROWS') or 100000)
+        interval = float(config.get('ARCHIVE_INTERVAL') or 1)
+        while True:
+            batch = await get_ingest_batch(self.queue, block_rows, interval)
+            rows = {}
+            for frame_rows, _, _, _ in batch:
+                for kind, kind_rows in frame_rows.items():
+                    rows.setdefault(kind, []).extend(kind_rows)
+            try:
+                await loop.run_in_executor(self.executor, self.writer.write, rows)
+                committed = True
+            except Exception as e:
+                logging.warning('archive to %s failed: %s', self.writer.directory, repr(e), exc_info=True)
+                committed = False
+            self.done(batch, [committed] * len(batch))
+
+    async def stop(self):
+        await super().stop()
+        self.executor.shutdown()
+
+
+def create_sinks(mysql_pool, writer_count):
+    queue_size = int(config.get('INGEST_QUEUE_SIZE') or 1000)
+    result = []
+    for name in (config.get('SINKS') or 'mysql').split(','):
+        name = name.strip()
+        if name == 'mysql':
+            result.append(MySQLSink(queue_size, mysql_pool, writer_count))
+        elif name == 'archive':
+            # writers of other servers and workers may share ARCHIVE_DIR, each one appends to its own files
+            writer = archive.ArchiveWriter(config.get('ARCHIVE_DIR') or 'logs/archive',
+                                           '%s-%d' % (socket.gethostname(), worker_index),
+                                           protocol.get_codec(config.get('ARCHIVE_COMPRESSION') or 'zlib'))
+            result.append(ArchiveSink(queue_size, writer))
+        elif name:
+            raise ValueError('unknown sink ' + name)
+    return result
+
+
+async def get_ingest_batch(queue, batch_size, interval):
+    """
+    wait for one frame, then keep collecting frames until batch_size rows or interval seconds
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    row_count = batch[0][1]
+    queue_wait_seconds.observe(loop.time() - batch[0][3])
+    deadline = loop.time() + interval
+    while row_count < batch_size:
+        if not queue.empty():
+            item = queue.get_nowait()
+        else:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        queue_wait_seconds.observe(loop.time() - item[3])
+        batch.append(item)
+        row_count += item[1]
+    return batch
+
+
+def is_data_error(e):
+    """
+    whether MySQL rejected the values of a row, writing the same rows again fails again
+    """
+    if isinstance(e, (pymysql.err.DataError, pymysql.err.IntegrityError)):
+        return True
+    return isinstance(e, pymysql.MySQLError) and len(e.args) > 0 and e.args[0] in DATA_ERRORS
+
+
+async def write_frames(pool, frames):
+    """
+    group the rows of frames ({kind: rows}) per table and write them in one transaction,
+    return (access log rows written, count of rows written)
+    """
+    table_rows = {}
+    # routed before taking a connection, creating a missing table takes one of its own
+    for rows in frames:
+        for row in rows.get('access', ()):
+            table_rows.setdefault(await log_table(pool, row), (logparse.LOG_COLUMNS, []))[1].append(row)
+        if 'slow' in rows:
+            table_rows.setdefault(await slow_log_table(pool), (logparse.SLOW_COLUMNS, []))[1].extend(rows['slow'])
     async with pool.acquire() as conn:
         async with conn.cursor() as cursor:
-            sql = "INSERT INTO mysql_slow(user, host, query_id, query_time, lock_time, rows_sent, rows_examined, " \
-                  "content, time) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
-            await cursor.execute(sql, tuple(row.values()))
+            for table, (columns, rows) in table_rows.items():
+                await insert_rows(cursor, table, columns, rows)
+                if columns is logparse.SLOW_COLUMNS:
+                    await cursor.executemany(slow_digest_sql(), slow_digest_rows(rows))
         await conn.commit()
+    return ([row for columns, rows in table_rows.values() if columns is logparse.LOG_COLUMNS for row in rows],
+            sum(len(rows) for _, rows in table_rows.values()))
+
+
+async def write_rejected_frame(pool, rows):
+    """
+    write a frame of a batch MySQL rejected on its own, else row by row leaving out the rows MySQL rejects.
+    return like write_frames, raise on errors other than rejected rows
+    """
+    try:
+        return await write_frames(pool, [rows])
+    except Exception as e:
+        if not is_data_error(e):
+            raise
+    written = []
+    row_count = 0
+    for kind, kind_rows in rows.items():
+        for row in kind_rows:
+            try:
+                written.extend((await write_frames(pool, [{kind: [row]}]))[0])
+                row_count += 1
+            except Exception as e:
+                if not is_data_error(e):
+                    raise
+                rows_rejected.inc()
+                logging.warning('%s row rejected: %s %s', kind, repr(e), repr(row))
+    return written, row_count
+
+
+async def write_rows(pool, sink):
+    """
+    writer task of the mysql sink: write the rows of queued frames in one transaction, then resolve each frame's
+    future with True once committed or False if the insert failed. a batch rejected for its data is written again
+    frame by frame and then row by row, the rejected rows are logged and their frames acknowledged, as sending
+    them again would fail forever
+    """
+    if load_data:
+        batch_size = int(config.get('LOAD_BATCH_SIZE') or 20000)
+    else:
+        batch_size = int(config.get('BATCH_SIZE') or 1000)
+    interval = float(config.get('BATCH_INTERVAL') or 1)
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await get_ingest_batch(sink.queue, batch_size, interval)
+        started = loop.time()
+        committed = [False] * len(batch)
+        written = []
+        row_count = 0
+        try:
+            written, row_count = await write_frames(pool, [rows for rows, _, _, _ in batch])
+            committed = [True] * len(batch)
+        except Exception as e:
+            insert_failures.inc()
+            if not is_data_error(e):
+                logging.warning('insert failed: %s', repr(e), exc_info=True)
+            else:
+                logging.warning('insert rejected, write the %d frames one by one: %s', len(batch), repr(e))
+                for i, (rows, _, _, _) in enumerate(batch):
+                    try:
+                        frame_written, frame_count = await write_rejected_frame(pool, rows)
+                        written.extend(frame_written)
+                        row_count += frame_count
+                        committed[i] = True
+                    except Exception as e:
+                        logging.warning('insert failed: %s', repr(e), exc_info=True)
+                        break
+        insert_seconds.observe(loop.time() - started)
+        rows_inserted.inc(row_count)
+        try:
+            if rollups is not None:
+                # only committed rows are aggregated, frames sent again after a failed insert are counted once
+                for row in written:
+                    rollups.add(row)
+        except Exception as e:
+            logging.warning('rollup failed: %s', repr(e), exc_info=True)
+        finally:
+            sink.done(batch, committed)
+
+
+def index_profile(kind):
+    profile = (config.get('INDEX_PROFILE') or 'none').lower()
+    if profile not in INDEX_PROFILES:
+        logging.warning('unknown index profile %s, use none', profile)
+        profile = 'none'
+    return INDEX_PROFILES[profile][kind]
+
+
+def index_sql(indexes):
+    """
+    the index definitions appended to a create table template
+    """
+    return ''.join(',\n\tindex %s (%s)' % index for index in indexes)
+
+
+@contextlib.asynccontextmanager
+async def ddl_lock(cursor):
+    """
+    named lock serializing table creation and changes between the workers of a server and the servers sharing
+    the database, whoever gets it second sees the table created by the first
+    """
+    name = config['DB_NAME'] + '.logbeat_ddl'
+    await cursor.execute("SELECT GET_LOCK(%s, %s)", (name, DDL_LOCK_TIMEOUT))
+    result = await cursor.fetchall()
+    if len(result) > 0 and result[0][0] != 1:
+        raise RuntimeError('timed out waiting for lock ' + name)
+    try:
+        yield
+    finally:
+        await cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        await cursor.fetchall()
+
+
+async def table_exists(cursor, table):
+    sql = "select TABLE_NAME from information_schema.TABLES where TABLE_SCHEMA=%s and TABLE_NAME=%s"
+    await cursor.execute(sql, (config['DB_NAME'], table))
+    return len(await cursor.fetchall()) > 0
 
 
 def read_create_sql():
@@ -66,8 +548,12 @@ async def create_table(pool, month=None):
         async with conn.cursor() as cursor:
             table_name = config['DB_PREFIX'] + month
             sql_content = read_create_sql()
-            sql = sql_content.format(table_name)
-            await cursor.execute(sql)
+            # lazy builds leave the current month without indexes, update_indexes adds them once the month closes
+            indexes = index_profile('log') if (config.get('INDEX_BUILD') or 'lazy') == 'eager' else ()
+            sql = sql_content.format(table_name, index_sql(indexes))
+            async with ddl_lock(cursor):
+                if not await table_exists(cursor, table_name):
+                    await cursor.execute(sql)
         await conn.commit()
         return table_name
 
@@ -82,79 +568,391 @@ async def create_slow_table(pool):
         async with conn.cursor() as cursor:
             table_name = 'mysql_slow'
             sql_content = read_slow_sql()
-            sql = sql_content.format(table_name)
-            await cursor.execute(sql)
+            sql = sql_content.format(table_name, index_sql(index_profile('slow')))
+            async with ddl_lock(cursor):
+                if not await table_exists(cursor, table_name):
+                    await cursor.execute(sql)
+                if not await table_exists(cursor, 'mysql_slow_digest'):
+                    await cursor.execute(read_slow_digest_sql().format('mysql_slow_digest'))
         await conn.commit()
+        existed_tables.add('mysql_slow_digest')
         return table_name
 
 
-def parse_log(message):
+def read_slow_digest_sql():
+    with open('create_slow_digest.template') as f:
+        return "".join(f.readlines())
+
+
+async def migrate_slow_table(pool):
+    """
+    add the fingerprint_hash column and the digest table to a mysql_slow created before them,
+    rows inserted before keep an empty fingerprint_hash
+    """
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            sql = "select COLUMN_NAME from information_schema.COLUMNS where TABLE_SCHEMA=%s and TABLE_NAME=%s " \
+                  "and COLUMN_NAME='fingerprint_hash'"
+            async with ddl_lock(cursor):
+                await cursor.execute(sql, (config['DB_NAME'], 'mysql_slow'))
+                if len(await cursor.fetchall()) == 0:
+                    logging.warning('add fingerprint_hash to mysql_slow')
+                    await cursor.execute("ALTER TABLE mysql_slow ADD COLUMN fingerprint_hash char(16) not null "
+                                         "default '', ADD INDEX idx_fingerprint (fingerprint_hash)")
+                if not await table_exists(cursor, 'mysql_slow_digest'):
+                    await cursor.execute(read_slow_digest_sql().format('mysql_slow_digest'))
+            existed_tables.add('mysql_slow_digest')
+        await conn.commit()
+
+
+def read_partitioned_sql():
+    with open('create_partitioned.template') as f:
+        return "".join(f.readlines())
+
+
+def partition_sql(day):
+    """
+    partition pYYYYMMDD holds the rows of that day
+    """
+    return "PARTITION p%s VALUES LESS THAN ('%s')" % (day.strftime('%Y%m%d'), (day + datetime.timedelta(days=1)))
+
+
+async def create_partitioned_table(pool):
+    today = datetime.date.today()
+    partitions = ["PARTITION pstart VALUES LESS THAN ('%s')" % today]
+    partitions += [partition_sql(today + datetime.timedelta(days=i)) for i in range(partition_ahead_days() + 1)]
+    partitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            sql = read_partitioned_sql().format(partition_table, ',\n\t'.join(partitions),
+                                               index_sql(index_profile('log')))
+            async with ddl_lock(cursor):
+                if not await table_exists(cursor, partition_table):
+                    await cursor.execute(sql)
+        await conn.commit()
+        return partition_table
+
+
+def partition_ahead_days():
+    return int(config.get('PARTITION_AHEAD_DAYS') or 7)
+
+
+async def update_partitions(pool):
+    """
+    split pmax into the daily partitions up to PARTITION_AHEAD_DAYS ahead,
+    drop partitions older than PARTITION_RETENTION_DAYS. servers sharing the database take turns
+    """
+    today = datetime.date.today()
+    retention_days = int(config.get('PARTITION_RETENTION_DAYS') or 0)
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            async with ddl_lock(cursor):
+                sql = "select PARTITION_NAME, PARTITION_DESCRIPTION from information_schema.PARTITIONS " \
+                      "where TABLE_SCHEMA=%s and TABLE_NAME=%s"
+                await cursor.execute(sql, (config['DB_NAME'], partition_table))
+                bounds = {}
+                for name, description in await cursor.fetchall():
+                    if description != 'MAXVALUE':
+                        bounds[name] = datetime.date.fromisoformat(description.strip("'")[0:10])
+                last_bound = max(bounds.values()) if len(bounds) > 0 else today
+                missing = [today + datetime.timedelta(days=i) for i in range(partition_ahead_days() + 1)]
+                missing = [day for day in missing if day >= last_bound]
+                if len(missing) > 0:
+                    partitions = [partition_sql(day) for day in missing]
+                    partitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+                    await cursor.execute("ALTER TABLE " + partition_table + " REORGANIZE PARTITION pmax INTO (" +
+                                         ", ".join(partitions) + ")")
+                if retention_days > 0:
+                    cutoff = today - datetime.timedelta(days=retention_days)
+                    expired = [name for name, bound in bounds.items() if bound <= cutoff]
+                    if len(expired) > 0:
+                        await cursor.execute("ALTER TABLE " + partition_table + " DROP PARTITION " +
+                                             ", ".join(expired))
+                        logging.info('dropped partitions %s of %s', ', '.join(expired), partition_table)
+        await conn.commit()
+
+
+def is_month_table(table):
+    month = table[len(config['DB_PREFIX']):]
+    return table.startswith(config['DB_PREFIX']) and len(month) == 6 and month.isdigit()
+
+
+async def update_indexes(pool, stop):
+    """
+    add the missing INDEX_PROFILE indexes to the monthly tables of closed months, which no longer take inserts
+    """
+    indexes = index_profile('log')
+    if len(indexes) == 0:
+        return
+    current_table = config['DB_PREFIX'] + time.strftime('%Y%m')
+    for table in sorted(existed_tables):
+        if stop.done():
+            return
+        if table in indexed_tables or not is_month_table(table) or table >= current_table:
+            continue
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                sql = "select INDEX_NAME from information_schema.STATISTICS where TABLE_SCHEMA=%s and TABLE_NAME=%s"
+                await cursor.execute(sql, (config['DB_NAME'], table))
+                existed_indexes = {row[0] for row in await cursor.fetchall()}
+                missing = [index for index in indexes if index[0] not in existed_indexes]
+                if len(missing) > 0:
+                    started = time.time()
+                    await cursor.execute("ALTER TABLE " + table + " " +
+                                         ", ".join("ADD INDEX %s (%s)" % index for index in missing) +
+                                         ", ALGORITHM=INPLACE, LOCK=NONE")
+                    logging.info('built indexes %s of %s in %.1fs', ', '.join(index[0] for index in missing), table,
+                                 time.time() - started)
+            await conn.commit()
+        indexed_tables.add(table)
+
+
+async def maintain_tables(pool, stop):
+    while not stop.done():
+        try:
+            if partition_table is not None:
+                await update_partitions(pool)
+            else:
+                await update_indexes(pool, stop)
+        except Exception as e:
+            logging.warning('maintain tables failed: %s', repr(e), exc_info=True)
+        await asyncio.wait([stop], timeout=3600)
+
+
+def read_rollup_sql():
+    with open('create_rollup.template') as f:
+        return "".join(f.readlines())
+
+
+async def create_rollup_table(pool):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            async with ddl_lock(cursor):
+                if not await table_exists(cursor, rollup_table):
+                    await cursor.execute(read_rollup_sql().format(rollup_table))
+        await conn.commit()
+        return rollup_table
+
+
+async def flush_rollups(pool, final=False):
     """
-    {"@timestamp":"2022-05-01T01:00:51+08:00","http_host":"xxx.yyy.zzz","clientip":"192.168.1.222",
-    "request":"POST /index.php?id=324 HTTP/1.1","status":"200","size":"44","upstream_addr":"127.0.0.1:9000",
-    "upstream_status":"200","upstream_response_time":"0.041","request_time":"0.041",
-    "http_referer":"","http_user_agent":"python-requests/2.26.0","http_x_forwarded_for":""}
+    write the minutes that closed ROLLUP_DELAY seconds ago, or all of them when final.
+    rows that failed to write are tried again on the next flush
     """
+    rows = pending_rollups + rollups.close(None if final else time.time())
+    pending_rollups.clear()
+    if len(rows) == 0:
+        return
     try:
-        raw_json = json.loads(message)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(insert_sql(rollup_table, rollup.ROLLUP_COLUMNS), rows)
+            await conn.commit()
     except Exception as e:
-        logging.warning(repr(e), exc_info=True)
-        return None
-    request_arr = raw_json['request'].split(' ')
-    request_uri = request_arr[1].split('?')
-    upstream_time = float(raw_json['time']) - float(raw_json['request_time'].replace('-', '0'))
-    parsed = {}
-    parsed['time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(float(raw_json['time']))) + raw_json['time'][-4:]
-    parsed['host'] = raw_json['http_host']
-    parsed['client_ip'] = raw_json['clientip']
-    parsed['request_uri'] = request_uri[0][0:191]
-    parsed['request_query'] = '' if len(request_uri) == 1 else request_uri[1][0:191]
-    parsed['request_version'] = request_arr[2].split('/')[1]
-    parsed['request_method'] = request_arr[0]
-    parsed['status'] = raw_json['status'].replace('-', '0')
-    parsed['size'] = raw_json['size'].replace('-', '0')
-    parsed['upstream_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(upstream_time)) + ('%.3f' % upstream_time)[-4:]
-    parsed['upstream_addr'] = raw_json['upstream_addr']
-    parsed['upstream_status'] = empty2int(raw_json['upstream_status'].replace('-', '0'))
-    parsed['upstream_response_time'] = empty2int(raw_json['upstream_response_time'].replace('-', '0'))
-    parsed['request_time'] = raw_json['request_time'].replace('-', '0')
-    parsed['connection_time'] = raw_json['connection_time']
-    parsed['http_referer'] = raw_json['http_referer'][0:191]
-    parsed['user_agent'] = raw_json['http_user_agent'][0:191]
-    parsed['x_forwarded_for'] = raw_json['http_x_forwarded_for'][0:191]
-    parsed['sess_tag'] = '' if 'oks_studious_robot' not in raw_json or len(raw_json['oks_studious_robot']) == 0 else \
-        sha256(raw_json['oks_studious_robot'].encode('utf-8')).hexdigest()
-    return parsed
-
-
-def empty2int(s):
-    return 0 if len(s) == 0 else s
-
-
-def parse_slow_log(message):
-    """
-    {"type": "mysql_slow_log", "user": "readonly", "host": "192.168.8.12", "query_id": "514412", "query_time": "3.265353",
-     "lock_time": "0.000033", "rows_sent": "0", "rows_examined": "1052915", "timestamp": "1660031855", "content": "select * from `users`
-    where `state` = 0 order by `id` desc limit 1;\n"}
+        logging.warning('insert into %s failed: %s', rollup_table, repr(e), exc_info=True)
+        pending_rollups.extend(rows)
+
+
+async def maintain_rollups(pool, stop):
+    while not stop.done():
+        await flush_rollups(pool)
+        await asyncio.wait([stop], timeout=10)
+
+
+def parse_frame(message):
+    """
+    unpack and parse one frame of lines, runs in the parse pool when PARSE_WORKERS is set.
+    return (seq, {kind: [row, ...]}, count of lines that failed to parse)
     """
     try:
-        raw_json = json.loads(message)
+        seq, lines = protocol.unpack_lines(message)
     except Exception as e:
-        logging.warning(repr(e), exc_info=True)
-        return None
-    del raw_json['type']
-    raw_json['time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(raw_json['timestamp'])))
-    del raw_json['timestamp']
-    logging.debug(raw_json)
-    return raw_json
-
-
-async def msg_handler(websocket, mysql_pool):
-    async for message in websocket:
-        if message.startswith('{"type": "mysql_slow_log",'):
-            await slow_log_insert(mysql_pool, parse_slow_log(message))
-        else:
-            await log_insert(mysql_pool, parse_log(message))
+        logging.warning('bad frame: %s', repr(e))
+        return None, {}, 0
+    kinds, errors = logparse.parse_lines(lines)
+    return seq, kinds, errors
+
+
+def create_parse_pool():
+    # forkserver workers do not inherit the sockets of this process, a forked worker would keep
+    # closed websocket connections half open
+    mp_context = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('forkserver')
+    return concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers, mp_context=mp_context)
+
+
+def restart_parse_pool(broken):
+    """
+    a parse worker killed by the OOM killer or SIGKILL breaks the pool, every later submit fails. the connections
+    finding it broken replace it once
+    """
+    global parse_pool
+    if parse_pool is broken:
+        logging.warning('a parse worker died, start the parse pool again')
+        broken.shutdown(wait=False, cancel_futures=True)
+        parse_pool = create_parse_pool()
+
+
+def submit_parse(message):
+    """
+    return (future of parse_frame(message) on the parse pool, the pool)
+    """
+    loop = asyncio.get_running_loop()
+    pool = parse_pool
+    try:
+        return loop.run_in_executor(pool, parse_frame, message), pool
+    except concurrent.futures.process.BrokenProcessPool:
+        restart_parse_pool(pool)
+        return loop.run_in_executor(parse_pool, parse_frame, message), parse_pool
+
+
+async def recent_handler(websocket):
+    """
+    /query?host=..&status=5xx&uri_prefix=/api/&since=300&limit=100 sends the newest matching rows and closes,
+    /tail with the same filters sends every batch of matching rows as they arrive
+    """
+    path, _, query = websocket.path.partition('?')
+    if recent_rows is None:
+        await websocket.close(1008, 'RECENT_ROWS is 0')
+        return
+    try:
+        row_filter, limit = recent.Filter.from_query(query)
+    except ValueError as e:
+        # a close reason is limited to 123 bytes
+        await websocket.close(1008, ('bad filter: %s' % e)[0:100])
+        return
+    if path == '/query':
+        rows = recent_rows.query(row_filter, limit)
+        await websocket.send(json.dumps({'columns': logparse.LOG_COLUMNS, 'rows': rows}))
+        await websocket.close()
+        return
+    subscriber = recent_rows.subscribe(row_filter)
+    closed = asyncio.ensure_future(websocket.wait_closed())
+    try:
+        await websocket.send(json.dumps({'columns': logparse.LOG_COLUMNS}))
+        while True:
+            get = asyncio.ensure_future(subscriber.queue.get())
+            await asyncio.wait((get, closed), return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                break
+            dropped, subscriber.dropped = subscriber.dropped, 0
+            await websocket.send(json.dumps({'rows': get.result(), 'dropped': dropped}))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        recent_rows.unsubscribe(subscriber)
+        closed.cancel()
+
+
+async def msg_handler(websocket):
+    if websocket.path.partition('?')[0] in ('/query', '/tail'):
+        await recent_handler(websocket)
+        return
+    loop = asyncio.get_running_loop()
+    frames = asyncio.Queue(maxsize=parse_backlog)
+    acks = asyncio.Queue()
+    insert_task = asyncio.create_task(insert_frames(frames, acks))
+    ack_task = asyncio.create_task(send_ack(websocket, acks))
+    # rows frames are parsed by the client and only decoded here, in order as they share the dictionary
+    decoder = protocol.RowDecoder()
+    connections.inc(1)
+    try:
+        async for message in websocket:
+            frames_received.inc()
+            bytes_received.inc(len(message))
+            if isinstance(message, bytes) and message[0:1] == bytes((protocol.FRAME_ROWS,)):
+                try:
+                    seq, kinds = decoder.unpack(message)
+                except Exception as e:
+                    logging.warning('bad rows frame from %s: %s', websocket.remote_address, repr(e))
+                    # the frames after it cannot be decoded either, the client sends them again on a new connection
+                    await websocket.close(1003, 'bad rows frame')
+                    break
+                parsed = loop.create_future()
+                parsed.set_result((seq, kinds, 0))
+                await frames.put((None, parsed, None, loop.time()))
+            elif parse_pool is None:
+                parsed = loop.create_future()
+                parsed.set_result(parse_frame(message))
+                await frames.put((None, parsed, None, loop.time()))
+            else:
+                parsed, pool = submit_parse(message)
+                await frames.put((message, parsed, pool, loop.time()))
+    except websockets.ConnectionClosedError as e:
+        logging.info('connection %s closed: %s', websocket.remote_address, repr(e))
+    finally:
+        connections.inc(-1)
+        # frames already received are still inserted, legacy clients have no other way to deliver them
+        await frames.put(None)
+        await insert_task
+        ack_task.cancel()
+
+
+async def insert_frames(frames, acks):
+    """
+    queue parsed frames for every sink in the order they were received. the put blocks while the queue of a sink
+    is full, so the connection stops reading until its writers catch up.
+    a frame that fails to parse closes the connection, the frames after it are not inserted and the client sends
+    them again on a new connection
+    """
+    loop = asyncio.get_running_loop()
+    failed = False
+    while True:
+        item = await frames.get()
+        if item is None:
+            return
+        message, parsed, pool, received = item
+        try:
+            if failed:
+                # only waited for, their rows would be inserted twice
+                await parsed
+                continue
+            try:
+                seq, kinds, errors = await parsed
+            except concurrent.futures.process.BrokenProcessPool:
+                # the frames in the pool when a worker died are parsed again on the new pool
+                restart_parse_pool(pool)
+                parsed, pool = submit_parse(message)
+                seq, kinds, errors = await parsed
+        except Exception as e:
+            if not failed:
+                logging.warning('parse frame failed: %s', repr(e))
+                failed = True
+                acks.put_nowait((None, None))
+            continue
+        parse_seconds.observe(loop.time() - received)
+        parse_errors.inc(errors)
+        row_count = sum(len(rows) for rows in kinds.values())
+        rows_parsed.inc(row_count)
+        if recent_rows is not None and 'access' in kinds:
+            recent_rows.add(kinds['access'])
+        committed = None
+        if row_count > 0:
+            # the sinks write in parallel, the frame is acknowledged once all of them have written it
+            committed = asyncio.gather(*[await sink.put(kinds, row_count) for sink in sinks])
+        if seq is not None:
+            acks.put_nowait((seq, committed))
+
+
+async def send_ack(websocket, acks):
+    """
+    acknowledge frames in order once their rows are committed, close the connection if an insert or a parse failed
+    so that the client sends the unacknowledged frames again
+    """
+    try:
+        while True:
+            seq, committed = await acks.get()
+            if seq is None:
+                await websocket.close(1011, 'parse failed')
+                return
+            if committed is not None and not all(await committed):
+                await websocket.close(1011, 'insert failed')
+                return
+            await websocket.send(protocol.pack_ack(seq))
+    except websockets.ConnectionClosed:
+        pass
 
 
 async def init_table(pool):
@@ -175,22 +973,119 @@ async def init_table(pool):
 
 
 async def server():
+    global load_data, parse_pool, parse_workers, parse_backlog, partition_table, rollups, rollup_table, recent_rows
     loop = asyncio.get_running_loop()
+    load_data = (config.get('WRITE_MODE') or 'insert') == 'load'
+    server_workers = int(config.get('SERVER_WORKERS') or 1)
+    parse_workers = config.get('PARSE_WORKERS') or '0'
+    # auto shares the cores between the server workers
+    parse_workers = max(1, os.cpu_count() // server_workers) if parse_workers == 'auto' else int(parse_workers)
+    if parse_workers > 0:
+        parse_pool = create_parse_pool()
+        # frames of one connection are parsed in parallel too, rows are still inserted in order
+        parse_backlog = parse_workers * 2
     stop = loop.create_future()
-    mysql_pool = await aiomysql.create_pool(host=config['DB_HOST'], port=int(config['DB_PORT']),
-                                            user=config['DB_USER'], password=config['DB_PASS'],
-                                            db=config['DB_NAME'], loop=loop)
-    existed_tables.extend(await init_table(mysql_pool))
+    pool_max = int(config.get('DB_POOL_MAX') or 10)
+    mysql_pool = None
+    maintain_task = None
+    rollup_task = None
+    if 'mysql' in [name.strip() for name in (config.get('SINKS') or 'mysql').split(',')]:
+        if (config.get('WRITE_MODE') or 'insert') == 'null':
+            mysql_pool = NullPool()
+        else:
+            mysql_pool = await aiomysql.create_pool(host=config['DB_HOST'], port=int(config['DB_PORT']),
+                                                    user=config['DB_USER'], password=config['DB_PASS'],
+                                                    db=config['DB_NAME'], minsize=int(config.get('DB_POOL_MIN') or 1),
+                                                    maxsize=pool_max, local_infile=load_data, loop=loop)
+        existed_tables.update(await init_table(mysql_pool))
+        if 'mysql_slow' in existed_tables:
+            await migrate_slow_table(mysql_pool)
+        if (config.get('STORAGE_LAYOUT') or 'monthly') == 'partitioned':
+            partition_table = config['DB_PREFIX'] + 'access'
+            if partition_table not in existed_tables:
+                existed_tables.add(await create_partitioned_table(mysql_pool))
+            if worker_index == 0:
+                maintain_task = asyncio.create_task(maintain_tables(mysql_pool, stop))
+        elif len(index_profile('log')) > 0 and worker_index == 0:
+            maintain_task = asyncio.create_task(maintain_tables(mysql_pool, stop))
+        if (config.get('ROLLUP') or 'off') == 'on':
+            rollup_table = config['DB_PREFIX'] + 'rollup'
+            if rollup_table not in existed_tables:
+                existed_tables.add(await create_rollup_table(mysql_pool))
+            # every worker flushes the rollups of its own rows, readers sum the partial rows of a minute
+            rollups = rollup.Rollup(int(config.get('ROLLUP_MAX_URIS') or 1000),
+                                    int(config.get('ROLLUP_DELAY') or 60))
+            rollup_task = asyncio.create_task(maintain_rollups(mysql_pool, stop))
+    metrics_port = config.get('METRICS_PORT')
+    if metrics_port:
+        # every worker has its own endpoint, on METRICS_PORT + worker index
+        metrics_port = int(metrics_port) + worker_index
+    metrics_server = await metrics.serve(config.get('METRICS_HOST'), metrics_port)
     loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    # one pool connection is left for table creation and one for table maintenance
+    reserved = 1 if maintain_task is None else 2
+    writer_count = int(config.get('WRITER_TASKS') or max(1, pool_max - reserved))
+    sinks.extend(create_sinks(mysql_pool, writer_count))
+    if int(config.get('RECENT_ROWS') or 0) > 0:
+        recent_rows = recent.RecentRows(int(config['RECENT_ROWS']))
+    for sink in sinks:
+        sink.start()
 
     # TODO: support wss
-    async with websockets.serve(lambda websocket: msg_handler(websocket, mysql_pool), config['WS_HOST'],
-                                config['WS_PORT'], create_protocol=websockets.basic_auth_protocol_factory(
+    async with websockets.serve(msg_handler, config['WS_HOST'], config['WS_PORT'],
+                                create_protocol=websockets.basic_auth_protocol_factory(
                 realm="auth", credentials=(config['WS_USER'], config['WS_PASS'])
-            ), ping_timeout=None):
+            ), ping_timeout=None, max_size=int(config.get('WS_MAX_SIZE') or 16 * 1024 * 1024),
+                                reuse_port=server_workers > 1):
         await stop
-    mysql_pool.close()
-    await mysql_pool.wait_closed()
+    for sink in sinks:
+        await sink.stop()
+    if maintain_task is not None:
+        await maintain_task
+    if rollup_task is not None:
+        await rollup_task
+        await flush_rollups(mysql_pool, True)
+    if metrics_server is not None:
+        metrics_server.close()
+    if mysql_pool is not None:
+        mysql_pool.close()
+        await mysql_pool.wait_closed()
+    if parse_pool is not None:
+        parse_pool.shutdown()
+
+
+def run_worker(index):
+    global worker_index
+    worker_index = index
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    asyncio.run(server())
+
+
+def run_workers(count):
+    """
+    fork count workers listening on WS_PORT together with SO_REUSEPORT, each with its own event loop and
+    database pool. a worker that dies is started again, SIGTERM is passed on to the workers
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    # the workers are forked before any event loop or pool exists in this process
+    context = multiprocessing.get_context('fork')
+    workers = {}
+    while len(stopping) == 0:
+        for index in range(count):
+            worker = workers.get(index)
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                logging.warning('worker %d exited with %s, start it again', index, worker.exitcode)
+                time.sleep(1)
+            workers[index] = context.Process(target=run_worker, args=(index,), name='logbeat-worker-%d' % index)
+            workers[index].start()
+        multiprocessing.connection.wait([worker.sentinel for worker in workers.values()], timeout=1)
+    for worker in workers.values():
+        worker.terminate()
+    for worker in workers.values():
+        worker.join()
 
 
 if __name__ == '__main__':
@@ -198,6 +1093,10 @@ if __name__ == '__main__':
     1. start websocket service
     2. insert received logs into mysql
     '''
-    config = dotenv_values()
+    # LOGBEAT_ENV selects another env file than .env, e.g. for the benchmark
+    config = dotenv_values(os.environ.get('LOGBEAT_ENV'))
     utils.init_logger(config['LOG_FILE'], config['LOG_LEVEL'])
-    asyncio.run(server())
+    if int(config.get('SERVER_WORKERS') or 1) > 1:
+        run_workers(int(config['SERVER_WORKERS']))
+    else:
+        asyncio.run(server())
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import asyncio
+import collections
 import concurrent.futures
 import json
 import logging
@@ -9,27 +10,26 @@ import signal
 import threading
 import time
 
-import websockets
 from dotenv import dotenv_values
 
+import inotify
+import metrics
+import shipper
+import tailer
 import utils
 
 watch_files = []
 read_lock = threading.Lock()
+inflight = collections.OrderedDict()
+
+CONNECT_PATTERN = re.compile(r'^# User@Host: (\w+)\[\w+]\s*@\s*(\w*)\s*\[(.*?)]\s*Id:\s*(\d+)$')
+QUERY_PATTERN = re.compile(r'^# Query_time: ([0-9.]+)\s*Lock_time: ([0-9.]+)\s*Rows_sent: ([0-9]+)\s*Rows_examined: '
+                           r'([0-9]+)$')
+TIMESTAMP_PATTERN = re.compile(r'^SET timestamp=([0-9]+);$')
 
 
 async def send_log(queue):
-    uri = "ws://" + config['WS_USER'] + ':' + config['WS_PASS'] + '@' + config['WS_HOST'] + ':' + config['WS_PORT']
-    async for websocket in websockets.connect(uri, ping_timeout=None):
-        try:
-            while websocket.open:
-                log = await queue.get()
-                await websocket.send(log)
-                queue.task_done()
-        except websockets.ConnectionClosed:
-            continue
-        except Exception as e:
-            logging.warning(repr(e), exc_info=True)
+    await shipper.send_log(shipper.endpoint_uris(config), queue, checkpoint, config, inflight)
 
 
 async def add_log(queue):
@@ -37,10 +37,11 @@ async def add_log(queue):
     with concurrent.futures.ThreadPoolExecutor() as pool:
         while True:
             result = await loop.run_in_executor(pool, watch_log)
-            for log in result:
+            for log, mark in result:
                 log_json = parse_log(log)
                 if log_json:
-                    await queue.put(log_json)
+                    # chunks are complete lines, batches are sized by their line count
+                    await queue.put((log_json.encode('utf-8') + b'\n', mark))
 
 
 def parse_log(log):
@@ -50,7 +51,7 @@ def parse_log(log):
     where `state` = 0 order by `id` desc limit 1;\n"]
     """
     log_dict = {'type': 'mysql_slow_log'}
-    connect_matches = re.match(r'^# User@Host: (\w+)\[\w+]\s*@\s*(\w*)\s*\[(.*?)]\s*Id:\s*(\d+)$', log[0])
+    connect_matches = CONNECT_PATTERN.match(log[0])
     if connect_matches:
         connect_info = connect_matches.groups()
         log_dict['user'] = connect_info[0]
@@ -60,8 +61,7 @@ def parse_log(log):
         logging.warning(log[0])
         return False
 
-    query_matches = re.match(r'^# Query_time: ([0-9.]+)\s*Lock_time: ([0-9.]+)\s*Rows_sent: ([0-9]+)\s*Rows_examined: '
-                             r'([0-9]+)$', log[1])
+    query_matches = QUERY_PATTERN.match(log[1])
     if query_matches:
         query_info = query_matches.groups()
         log_dict['query_time'] = query_info[0]
@@ -72,12 +72,12 @@ def parse_log(log):
         logging.warning(log[1])
         return False
 
-    timestamp_matches = re.match(r'^SET timestamp=([0-9]+);$', log[2])
+    timestamp_matches = TIMESTAMP_PATTERN.match(log[2])
     if timestamp_matches:
         log_dict['timestamp'] = timestamp_matches.group(1)
         log.remove(log[2])
     else:
-        timestamp_matches = re.match(r'^SET timestamp=([0-9]+);$', log[3])
+        timestamp_matches = TIMESTAMP_PATTERN.match(log[3])
         if timestamp_matches:
             log_dict['timestamp'] = timestamp_matches.group(1)
             log.remove(log[3])
@@ -94,41 +94,64 @@ def watch_log():
     SET timestamp=1660031855;
     select * from `users` where `state` = 0 order by `id` desc limit 1;
     """
-    def save_result(line_list, result_list):
+    def save_result(line_list, result_list, mark):
         if len(line_list) > 0:
-            result_list.append(line_list)
+            result_list.append((line_list, mark))
         return []
 
     start_time = time.time()
     result = []
     with read_lock:
-        for fp in watch_files:
+        for log_tailer in watch_files:
+            if notifier is not None and not notifier.is_dirty(log_tailer):
+                continue
             new_log = []
-            while fp.readable():
-                line = fp.readline()
-                if line:
+            log_offset = log_tailer.offset
+            while True:
+                chunk = log_tailer.read()
+                if not chunk:
+                    save_result(new_log, result, log_tailer.mark())
+                    if notifier is not None:
+                        notifier.clean(log_tailer)
+                    break
+                pos = log_tailer.offset - len(chunk)
+                for raw_line in chunk.split(b'\n')[:-1]:
+                    line = raw_line.decode('utf-8', errors='ignore') + '\n'
                     if line.startswith(r"# Time:"):
-                        new_log = save_result(new_log, result)
+                        new_log = save_result(new_log, result, (log_tailer.name, log_tailer.ino, pos))
                     elif line.startswith(r'# User@Host:'):
-                        save_result(new_log, result)
+                        save_result(new_log, result, (log_tailer.name, log_tailer.ino, pos))
                         new_log = [line]
+                        log_offset = pos
                     elif len(new_log) > 0:
                         new_log.append(line)
-                else:
-                    save_result(new_log, result)
-                    break
-                if len(result) >= 10 and len(new_log) == 0:
+                    pos += len(raw_line) + 1
+                if len(result) >= 10:
+                    if len(new_log) > 0:
+                        # the unfinished entry is read again next time
+                        log_tailer.seek(log_offset)
                     return result
-            else:
-                logging.warning('not readable: %s', fp.name)
-    if time.time() - start_time < 1:
+    if notifier is not None:
+        if len(result) == 0:
+            notifier.wait(1)
+    elif time.time() - start_time < 1:
         time.sleep(1)
     return result
 
 
+def queue_gauges(queue):
+    metrics.Gauge('logbeat_queue_items', 'chunks waiting to be sent', function=queue.qsize)
+    metrics.Gauge('logbeat_inflight_batches', 'batches sent and not acknowledged yet', function=lambda: len(inflight))
+    if isinstance(queue, shipper.SpillQueue):
+        metrics.Gauge('logbeat_spill_bytes', 'bytes of segment files in the spill directory',
+                      function=lambda: queue.disk_bytes)
+
+
 async def client():
-    open_files()
-    g_queue = asyncio.Queue(maxsize=10000)
+    g_queue = shipper.create_queue(config.get('SLOW_SPILL_DIR'), config)
+    open_files(offset_dict=shipper.spilled_offsets(g_queue))
+    queue_gauges(g_queue)
+    metrics_server = await metrics.serve(config.get('METRICS_HOST'), config.get('SLOW_METRICS_PORT'))
     watch_task = asyncio.create_task(add_log(g_queue))
     send_task = asyncio.create_task(send_log(g_queue))
     loop = asyncio.get_running_loop()
@@ -141,9 +164,10 @@ async def client():
         logging.warning(repr(e), exc_info=True)
         watch_task.cancel()
     finally:
-        await g_queue.join()
-        send_task.cancel()
+        await shipper.shutdown(g_queue, send_task, inflight, float(config.get('SHUTDOWN_TIMEOUT') or 10))
         close_open_files()
+        if metrics_server is not None:
+            metrics_server.close()
 
 
 def open_files(seek=False, offset_dict=None):
@@ -151,17 +175,20 @@ def open_files(seek=False, offset_dict=None):
         offset_dict = {}
     try:
         offset_ino = offset_dict.keys()
-        log_fp = open(config['SLOW_LOG'], errors='ignore')
-        if log_fp.readable():
-            if seek or len(offset_dict) > 0:
-                stat = os.stat(config['SLOW_LOG'])
-                if stat.st_ino in offset_ino:
-                    log_fp.seek(offset_dict[stat.st_ino])
-                elif seek:
-                    log_fp.seek(stat[6])
-            elif re.match(r'\d+', config['SLOW_LOG_OFFSET']):
-                log_fp.seek(int(config['SLOW_LOG_OFFSET']))
-            watch_files.append(log_fp)
+        log_tailer = tailer.FileTailer(config['SLOW_LOG'])
+        size = log_tailer.size()
+        acked_offset = checkpoint.get(config['SLOW_LOG'], log_tailer.ino)
+        if log_tailer.ino in offset_ino and offset_dict[log_tailer.ino] <= size:
+            log_tailer.seek(offset_dict[log_tailer.ino])
+        elif acked_offset is not None and acked_offset <= size:
+            log_tailer.seek(acked_offset)
+        elif seek:
+            log_tailer.seek(size)
+        elif re.match(r'\d+', config['SLOW_LOG_OFFSET']):
+            log_tailer.seek(int(config['SLOW_LOG_OFFSET']))
+        watch_files.append(log_tailer)
+        if notifier is not None:
+            notifier.watch(log_tailer, config['SLOW_LOG'])
     except Exception as e:
         logging.warning('open log failed: ' + repr(e))
     if len(watch_files) == 0:
@@ -169,20 +196,16 @@ def open_files(seek=False, offset_dict=None):
         exit(0)
 
 
-def close_open_files(read_finial=False, save_offset=False):
-    finial_lines = []
+def close_open_files(save_offset=False):
     offset_dict = {}
-    for fp in watch_files:
-        if fp.readable():
-            if read_finial:
-                finial_lines.extend(fp.readlines())
-            if save_offset:
-                offset_dict[os.stat(fp.name).st_ino] = fp.tell()
-            fp.close()
-            watch_files.remove(fp)
-    if save_offset:
-        return offset_dict
-    return finial_lines
+    for log_tailer in list(watch_files):
+        if save_offset:
+            offset_dict[log_tailer.ino] = log_tailer.offset
+        if notifier is not None:
+            notifier.unwatch(log_tailer)
+        log_tailer.close()
+        watch_files.remove(log_tailer)
+    return offset_dict
 
 
 def update_watch():
@@ -195,6 +218,9 @@ if __name__ == '__main__':
     '''
     scan log to queue, then send log
     '''
-    config = dotenv_values()
+    # LOGBEAT_ENV selects another env file than .env, e.g. for the benchmark
+    config = dotenv_values(os.environ.get('LOGBEAT_ENV'))
     utils.init_logger(config['LOG_FILE'], config['LOG_LEVEL'])
+    checkpoint = shipper.Checkpoint(config.get('SLOW_CHECKPOINT_FILE') or 'logs/slow_checkpoint.json')
+    notifier = inotify.create(config.get('TAIL_MODE'))
     asyncio.run(client())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import json
+import logging
+import re
+import time
+from hashlib import md5, sha256
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# insert tuples are built in this column order
+LOG_COLUMNS = ('time', 'host', 'client_ip', 'request_uri', 'request_query', 'request_version', 'request_method',
+               'status', 'size', 'upstream_time', 'upstream_addr', 'upstream_status', 'upstream_response_time',
+               'request_time', 'connection_time', 'http_referer', 'user_agent', 'x_forwarded_for', 'sess_tag')
+SLOW_COLUMNS = ('user', 'host', 'query_id', 'query_time', 'lock_time', 'rows_sent', 'rows_examined', 'content', 'time',
+                'fingerprint_hash')
+# slow log lines are the json the slow client builds, everything else is an access log line
+SLOW_PREFIX = '{"type": "mysql_slow_log",'
+
+# fingerprint normalization, in the order applied
+COMMENT_PATTERN = re.compile(r'/\*.*?\*/|(?:--|#)[^\n]*', re.S)
+USE_PATTERN = re.compile(r'^\s*use\s+`?\w+`?\s*;', re.I)
+STRING_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"", re.S)
+NUMBER_PATTERN = re.compile(r'(?<![\w.`])(?:0x[0-9a-f]+|[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?)\b', re.I)
+NULL_PATTERN = re.compile(r'\bnull\b', re.I)
+SPACE_PATTERN = re.compile(r'\s+')
+IN_LIST_PATTERN = re.compile(r'\b(in|values)\s*\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*',
+                             re.I)
+
+time_cache = {}
+
+
+def format_second(second):
+    """
+    strftime of a unix second, thousands of rows share the same second so the result is cached
+    """
+    formatted = time_cache.get(second)
+    if formatted is None:
+        if len(time_cache) >= 4096:
+            time_cache.clear()
+        formatted = time_cache[second] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+    return formatted
+
+
+def format_msec(msec):
+    second, millisecond = divmod(msec, 1000)
+    return format_second(second) + '.%03d' % millisecond
+
+
+def split_request(request):
+    """
+    'POST /index.php?id=324 HTTP/1.1' -> (method, uri, query, version), tolerate malformed request lines
+    such as '', '-', 'GET /' or binary garbage
+    """
+    if ' ' not in request:
+        return '', request[0:191], '', ''
+    method, _, rest = request.partition(' ')
+    if ' ' in rest:
+        target, _, protocol = rest.rpartition(' ')
+    else:
+        target, protocol = rest, ''
+    uri, _, query = target.partition('?')
+    return method[0:10], uri[0:191], query[0:191], protocol.partition('/')[2][0:10]
+
+
+def dash2zero(s):
+    return s.replace('-', '0')
+
+
+def empty2int(s):
+    return 0 if len(s) == 0 else s
+
+
+def first_upstream(s):
+    """
+    nginx logs a value per upstream tried, ', ' separated, and ' : ' between upstream groups after an internal
+    redirect: '502, 200' -> '502'. the first value is kept, like rollup.bucket does
+    """
+    if ',' in s or ':' in s:
+        return s.partition(',')[0].partition(':')[0].strip()
+    return s
+
+
+def parse_log(message):
+    """
+    {"@timestamp":"2022-05-01T01:00:51+08:00","time":"1651338051.123","http_host":"xxx.yyy.zzz",
+    "clientip":"192.168.1.222","request":"POST /index.php?id=324 HTTP/1.1","status":"200","size":"44",
+    "upstream_addr":"127.0.0.1:9000","upstream_status":"200","upstream_response_time":"0.041",
+    "request_time":"0.041","connection_time":"1","http_referer":"","http_user_agent":"python-requests/2.26.0",
+    "http_x_forwarded_for":""}
+    return the insert tuple in LOG_COLUMNS order or None
+    """
+    try:
+        raw_json = loads(message)
+        msec = round(float(raw_json['time']) * 1000)
+        request_time = dash2zero(raw_json.get('request_time', '0'))
+        method, uri, query, version = split_request(raw_json.get('request', ''))
+        robot = raw_json.get('oks_studious_robot')
+        return (
+            format_msec(msec),
+            raw_json.get('http_host', ''),
+            raw_json.get('clientip', ''),
+            uri,
+            query,
+            version,
+            method,
+            dash2zero(raw_json.get('status', '0')),
+            dash2zero(raw_json.get('size', '0')),
+            format_msec(msec - round(float(request_time or 0) * 1000)),
+            raw_json.get('upstream_addr', ''),
+            empty2int(dash2zero(first_upstream(raw_json.get('upstream_status', '')))),
+            empty2int(dash2zero(first_upstream(raw_json.get('upstream_response_time', '')))),
+            request_time,
+            raw_json.get('connection_time') or '0',
+            raw_json.get('http_referer', '')[0:191],
+            raw_json.get('http_user_agent', '')[0:191],
+            raw_json.get('http_x_forwarded_for', '')[0:191],
+            sha256(robot.encode('utf-8')).hexdigest() if robot else '',
+        )
+    except Exception as e:
+        logging.warning('parse log failed: %s %s', repr(e), message)
+        return None
+
+
+def fingerprint(query):
+    """
+    "SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'" -> 'select * from t where id in(?+) and name = ?'
+    """
+    query = COMMENT_PATTERN.sub('', query)
+    query = USE_PATTERN.sub('', query)
+    query = STRING_PATTERN.sub('?', query)
+    query = NUMBER_PATTERN.sub('?', query)
+    query = NULL_PATTERN.sub('?', query)
+    query = SPACE_PATTERN.sub(' ', query).strip().rstrip(';').strip().lower()
+    return IN_LIST_PATTERN.sub(r'\1(?+)', query)
+
+
+def fingerprint_hash(fingerprint_text):
+    return md5(fingerprint_text.encode('utf-8')).hexdigest()[16:]
+
+
+def parse_slow_log(message):
+    """
+    {"type": "mysql_slow_log", "user": "readonly", "host": "192.168.8.12", "query_id": "514412", "query_time": "3.265353",
+     "lock_time": "0.000033", "rows_sent": "0", "rows_examined": "1052915", "timestamp": "1660031855", "content": "select * from `users`
+    where `state` = 0 order by `id` desc limit 1;\n"}
+    return the insert tuple in SLOW_COLUMNS order or None
+    """
+    try:
+        raw_json = loads(message)
+        return (
+            raw_json['user'],
+            raw_json['host'],
+            raw_json['query_id'],
+            raw_json['query_time'],
+            raw_json['lock_time'],
+            raw_json['rows_sent'],
+            raw_json['rows_examined'],
+            raw_json['content'],
+            format_second(int(raw_json['timestamp'])),
+            fingerprint_hash(fingerprint(raw_json['content'])),
+        )
+    except Exception as e:
+        logging.warning('parse slow log failed: %s %s', repr(e), message)
+        return None
+
+
+def parse_line(line):
+    """
+    return (kind, insert tuple or None), kind is 'access' or 'slow'
+    """
+    if line.startswith(SLOW_PREFIX):
+        return 'slow', parse_slow_log(line)
+    return 'access', parse_log(line)
+
+
+def parse_lines(lines):
+    """
+    return ({kind: [insert tuple, ...]}, count of lines that failed to parse)
+    """
+    kinds = {}
+    errors = 0
+    for line in lines:
+        kind, row = parse_line(line)
+        if row is None:
+            errors += 1
+        else:
+            kinds.setdefault(kind, []).append(row)
+    return kinds, errors
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+import asyncio
+import bisect
+import logging
+import threading
+
+# every metric created is rendered by the endpoint of the process
+registry = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        """
+        function, when given, is called on every scrape and returns the value or {label values: value}
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                if len(self.values) == 0 and len(self.labels) == 0:
+                    return [((), 0)]
+                return list(self.values.items())
+        values = self.function()
+        if isinstance(values, dict):
+            return list(values.items())
+        return [((), values)]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.type)]
+        for label_values, value in self.samples():
+            lines.append('%s%s %s' % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, cumulative))
+        cumulative += counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, cumulative))
+        lines.append('%s_sum %s' % (self.name, total))
+        lines.append('%s_count %d' % (self.name, cumulative))
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logging.warning('render metric %s failed: %s', metric.name, repr(e))
+    return '\n'.join(lines) + '\n'
+
+
+async def handle(reader, writer):
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+        if request.startswith(b'GET /metrics ') or request.startswith(b'GET / '):
+            body = render().encode('utf-8')
+            status = b'200 OK'
+        else:
+            body = b'not found\n'
+            status = b'404 Not Found'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    """
+    Prometheus text format on http://host:port/metrics, return the asyncio server or None when port is empty
+    """
+    if not port:
+        return None
+    return await asyncio.start_server(handle, host or '127.0.0.1', int(port))
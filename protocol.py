@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+import array
+import itertools
+import logging
+import struct
+import sys
+import zlib
+
+import logparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# binary frames start with a header: frame type, payload codec, sequence number
+# text frames are the legacy format, one or more log lines separated by '\n', and are never acknowledged
+FRAME_LINES = 1
+FRAME_ACK = 2
+FRAME_ROWS = 3
+HEADER = struct.Struct('!BBQ')
+
+# FRAME_ROWS carries parsed rows instead of lines, the payload is little endian:
+#   schema version, group count
+#   the strings added to the dictionary of the connection by this frame
+#   per group: kind, row count, column count, then per column a mode and
+#     MODE_DICTIONARY: a u32 dictionary id per row
+#     MODE_LITERAL: the strings of the column
+#     MODE_LITERAL_ZEROS: the strings of the column with '' for the int 0, then the u32 count and u32 row indexes
+#       of the int 0 values
+# strings are a u32 count, the u32 length in characters of every string, the u32 byte length of the utf-8 text of
+# all strings and the text. id 0 of the dictionary is the int 0 parse_log gives empty upstream columns, the
+# strings get ids from 1 in the order they are added. both ends drop the dictionary with the connection
+ROWS_SCHEMA = 1
+ROW_KINDS = ('access', 'slow')
+# columns of the rows of every kind
+ROW_COLUMNS = (len(logparse.LOG_COLUMNS), len(logparse.SLOW_COLUMNS))
+ROWS_HEADER = struct.Struct('<BB')
+GROUP_HEADER = struct.Struct('<BIB')
+COUNT = struct.Struct('<I')
+MODE_DICTIONARY = 0
+MODE_LITERAL = 1
+MODE_LITERAL_ZEROS = 2
+# strings a sender adds to the dictionary of a connection at most, later new strings are sent inline
+DICTIONARY_SIZE = 65536
+U32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {'none': CODEC_NONE, 'deflate': CODEC_NONE, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+
+def get_codec(name):
+    """
+    'deflate' leaves the payload uncompressed and relies on the websocket permessage-deflate extension,
+    the other codecs compress the payload themselves
+    """
+    codec = CODECS.get((name or 'deflate').lower())
+    if codec is None:
+        logging.warning('unknown compression %s, use deflate', name)
+        return CODEC_NONE
+    if codec == CODEC_ZSTD and zstandard is None:
+        logging.warning('zstandard is not installed, use zlib')
+        return CODEC_ZLIB
+    return codec
+
+
+def ws_compression(name):
+    return 'deflate' if (name or 'deflate').lower() == 'deflate' else None
+
+
+def compress(payload, codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(payload, 1)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+
+def decompress(payload, codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd frame received but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
+
+
+def pack_lines(chunks, codec=CODEC_NONE, seq=0):
+    """
+    chunks are bytes holding one or more '\n' separated lines
+    """
+    payload = b'\n'.join(chunk.rstrip(b'\n') for chunk in chunks)
+    return HEADER.pack(FRAME_LINES, codec, seq) + compress(payload, codec)
+
+
+def unpack_lines(message):
+    """
+    return (seq, lines), seq is None for legacy text frames
+    """
+    if isinstance(message, str):
+        return None, [line for line in message.split('\n') if line]
+    frame_type, codec, seq = HEADER.unpack_from(message)
+    if frame_type != FRAME_LINES:
+        raise ValueError('unknown frame type %d' % frame_type)
+    payload = decompress(message[HEADER.size:], codec).decode('utf-8', errors='ignore')
+    return seq, [line for line in payload.split('\n') if line]
+
+
+def pack_ack(seq):
+    return HEADER.pack(FRAME_ACK, CODEC_NONE, seq)
+
+
+def unpack_ack(message):
+    frame_type, _, seq = HEADER.unpack_from(message)
+    if frame_type != FRAME_ACK:
+        raise ValueError('unknown frame type %d' % frame_type)
+    return seq
+
+
+def pack_u32(values):
+    data = array.array(U32, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpack_u32(payload, offset, count):
+    data = array.array(U32)
+    data.frombytes(payload[offset:offset + 4 * count])
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+
+def pack_strings(values):
+    text = ''.join(values).encode('utf-8', errors='surrogatepass')
+    return COUNT.pack(len(values)) + pack_u32([len(value) for value in values]) + COUNT.pack(len(text)) + text
+
+
+def unpack_strings(payload, offset):
+    """
+    return (strings, offset after them)
+    """
+    count = COUNT.unpack_from(payload, offset)[0]
+    lengths = unpack_u32(payload, offset + COUNT.size, count)
+    offset += COUNT.size + 4 * count
+    size = COUNT.unpack_from(payload, offset)[0]
+    offset += COUNT.size
+    text = payload[offset:offset + size].decode('utf-8', errors='surrogatepass')
+    if len(lengths) != count or sum(lengths) != len(text):
+        raise ValueError('truncated strings')
+    return [text[end - length:end] for length, end in zip(lengths, itertools.accumulate(lengths))], offset + size
+
+
+class RowEncoder:
+    """
+    sending end of the FRAME_ROWS dictionary of a connection. a column is sent as dictionary ids unless most of its
+    values differ within the frame (times, client ips, sizes) or the dictionary is full, then as literal strings
+    """
+
+    def __init__(self, size=DICTIONARY_SIZE):
+        self.size = size
+        self.ids = {0: 0}
+
+    def pack(self, groups, codec=CODEC_NONE, seq=0):
+        """
+        groups is {kind: [row tuple, ...]}, values are str or the int 0, other values arrive as str
+        """
+        added = []
+        parts = [b'']
+        for kind, rows in groups.items():
+            columns = list(zip(*rows))
+            parts.append(GROUP_HEADER.pack(ROW_KINDS.index(kind), len(rows), len(columns)))
+            for column in columns:
+                distinct = set(column)
+                missing = [value for value in distinct if value not in self.ids]
+                if len(distinct) > len(column) // 2 or len(self.ids) + len(missing) > self.size:
+                    if all(type(value) is str for value in distinct):
+                        parts.append(bytes((MODE_LITERAL,)) + pack_strings(column))
+                    else:
+                        zeros = [i for i, value in enumerate(column) if type(value) is not str]
+                        parts.append(bytes((MODE_LITERAL_ZEROS,)) +
+                                     pack_strings([value if type(value) is str else '' for value in column]) +
+                                     COUNT.pack(len(zeros)) + pack_u32(zeros))
+                    continue
+                for value in missing:
+                    self.ids[value] = len(self.ids)
+                    added.append(str(value))
+                ids = self.ids
+                parts.append(bytes((MODE_DICTIONARY,)) + pack_u32([ids[value] for value in column]))
+        parts[0] = ROWS_HEADER.pack(ROWS_SCHEMA, len(groups)) + pack_strings(added)
+        return HEADER.pack(FRAME_ROWS, codec, seq) + compress(b''.join(parts), codec)
+
+
+class RowDecoder:
+    """
+    receiving end of the FRAME_ROWS dictionary of a connection, frames must be unpacked in the order they were sent
+    """
+
+    def __init__(self):
+        self.dictionary = [0]
+
+    def unpack(self, message):
+        """
+        return (seq, {kind: [row tuple, ...]}), a frame that fails to unpack leaves the dictionary unusable
+        """
+        frame_type, codec, seq = HEADER.unpack_from(message)
+        if frame_type != FRAME_ROWS:
+            raise ValueError('unknown frame type %d' % frame_type)
+        payload = decompress(message[HEADER.size:], codec)
+        schema, group_count = ROWS_HEADER.unpack_from(payload)
+        if schema != ROWS_SCHEMA:
+            raise ValueError('unknown rows schema %d' % schema)
+        added, offset = unpack_strings(payload, ROWS_HEADER.size)
+        dictionary = self.dictionary
+        if len(dictionary) + len(added) > 2 * DICTIONARY_SIZE:
+            raise ValueError('dictionary of more than %d strings' % (2 * DICTIONARY_SIZE))
+        dictionary.extend(added)
+        groups = {}
+        for _ in range(group_count):
+            kind, row_count, column_count = GROUP_HEADER.unpack_from(payload, offset)
+            offset += GROUP_HEADER.size
+            if kind >= len(ROW_KINDS):
+                raise ValueError('unknown row kind %d' % kind)
+            if column_count != ROW_COLUMNS[kind] and row_count > 0:
+                raise ValueError('%s rows of %d columns instead of %d' % (ROW_KINDS[kind], column_count,
+                                                                           ROW_COLUMNS[kind]))
+            columns = []
+            for _ in range(column_count):
+                mode = payload[offset]
+                if mode == MODE_LITERAL:
+                    values, offset = unpack_strings(payload, offset + 1)
+                elif mode == MODE_LITERAL_ZEROS:
+                    values, offset = unpack_strings(payload, offset + 1)
+                    count = COUNT.unpack_from(payload, offset)[0]
+                    zeros = unpack_u32(payload, offset + COUNT.size, count)
+                    offset += COUNT.size + 4 * count
+                    if len(zeros) != count or (count > 0 and max(zeros) >= len(values)):
+                        raise ValueError('truncated column')
+                    for i in zeros:
+                        values[i] = 0
+                elif mode == MODE_DICTIONARY:
+                    ids = unpack_u32(payload, offset + 1, row_count)
+                    offset += 1 + 4 * row_count
+                    values = [dictionary[i] for i in ids]
+                else:
+                    raise ValueError('unknown column mode %d' % mode)
+                if len(values) != row_count:
+                    raise ValueError('truncated column')
+                columns.append(values)
+            groups.setdefault(ROW_KINDS[kind], []).extend(zip(*columns))
+        return seq, groups
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+import array
+import asyncio
+import bisect
+import collections
+import functools
+import time
+import urllib.parse
+
+import logparse
+
+TIME, HOST, URI, STATUS = (logparse.LOG_COLUMNS.index(name) for name in ('time', 'host', 'request_uri', 'status'))
+# batches of rows a live tail subscriber may fall behind before rows are dropped for it
+TAIL_BACKLOG = 100
+
+
+def uri_key(uri):
+    """
+    first path segment, the key of the uri index: '/api/v1/orders' -> '/api'
+    """
+    end = uri.find('/', 1)
+    return uri if end < 0 else uri[0:end]
+
+
+class Filter:
+    """
+    conditions on access log rows, all optional: host, status ('503' or a class like '5xx'), uri_prefix and since,
+    a 'YYYY-MM-DD HH:MM:SS' time prefix
+    """
+
+    def __init__(self, host=None, status=None, uri_prefix=None, since=None):
+        self.host = host
+        self.status = None
+        self.status_class = None
+        if status:
+            if status[1:].lower() == 'xx':
+                self.status_class = status[0]
+            else:
+                self.status = status
+                self.status_class = status[0]
+        self.uri_prefix = uri_prefix
+        self.since = since
+
+    @classmethod
+    def from_query(cls, query):
+        """
+        '?host=www.example.com&status=5xx&uri_prefix=/api/&since=300', since is seconds back from now.
+        return (filter, limit)
+        """
+        params = {name: values[-1] for name, values in urllib.parse.parse_qs(query).items()}
+        since = None
+        if params.get('since'):
+            since = logparse.format_msec(round((time.time() - float(params['since'])) * 1000))
+        return (cls(params.get('host'), params.get('status'), params.get('uri_prefix'), since),
+                int(params.get('limit') or 100))
+
+    def match(self, row):
+        if self.host is not None and row[HOST] != self.host:
+            return False
+        if self.status_class is not None and not row[STATUS].startswith(self.status_class):
+            return False
+        if self.status is not None and row[STATUS] != self.status:
+            return False
+        if self.uri_prefix is not None and not row[URI].startswith(self.uri_prefix):
+            return False
+        if self.since is not None and row[TIME] < self.since:
+            return False
+        return True
+
+
+class Subscriber:
+    def __init__(self, row_filter):
+        self.filter = row_filter
+        self.queue = asyncio.Queue(maxsize=TAIL_BACKLOG)
+        # matching rows not queued since the last batch taken, the subscriber was too slow for them
+        self.dropped = 0
+
+
+class RecentRows:
+    """
+    the last size access log rows in arrival order, with indexes of the sequence numbers of the rows per host,
+    status class and first uri segment. stale index entries are swept every size rows, so the indexes hold at most
+    two windows of sequence numbers. add and query run on the event loop
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.rows = [None] * size
+        # sequence number of the next row
+        self.next = 0
+        self.swept_at = 0
+        self.hosts = collections.defaultdict(functools.partial(array.array, 'q'))
+        self.statuses = collections.defaultdict(functools.partial(array.array, 'q'))
+        self.uris = collections.defaultdict(functools.partial(array.array, 'q'))
+        # the same uris repeat all day, their index keys are cached
+        self.uri_keys = {}
+        self.subscribers = set()
+
+    def __len__(self):
+        return min(self.next, self.size)
+
+    def oldest(self):
+        return max(0, self.next - self.size)
+
+    def add(self, rows):
+        ring = self.rows
+        size = self.size
+        hosts = self.hosts
+        statuses = self.statuses
+        uris = self.uris
+        uri_keys = self.uri_keys
+        seq = self.next
+        for row in rows:
+            ring[seq % size] = row
+            hosts[row[HOST]].append(seq)
+            statuses[row[STATUS][0:1]].append(seq)
+            uri = row[URI]
+            key = uri_keys.get(uri)
+            if key is None:
+                if len(uri_keys) >= 65536:
+                    uri_keys.clear()
+                key = uri_keys[uri] = uri_key(uri)
+            uris[key].append(seq)
+            seq += 1
+        self.next = seq
+        if self.next - self.swept_at >= self.size:
+            self.sweep()
+        for subscriber in self.subscribers:
+            matched = [row for row in rows if subscriber.filter.match(row)]
+            if len(matched) == 0:
+                continue
+            if subscriber.queue.full():
+                subscriber.dropped += len(matched)
+            else:
+                subscriber.queue.put_nowait(matched)
+
+    def sweep(self):
+        oldest = self.oldest()
+        for index in (self.hosts, self.statuses, self.uris):
+            for key in list(index):
+                seqs = index[key]
+                del seqs[0:bisect.bisect_left(seqs, oldest)]
+                if len(seqs) == 0:
+                    del index[key]
+        self.swept_at = self.next
+
+    def candidates(self, row_filter):
+        """
+        the shortest index holding every row the filter can match, None when no index applies
+        """
+        found = []
+        if row_filter.host is not None:
+            found.append(self.hosts.get(row_filter.host, ()))
+        if row_filter.status_class is not None:
+            found.append(self.statuses.get(row_filter.status_class, ()))
+        # '/api' could also be the start of '/apix', only a prefix with a whole first segment uses the index
+        if row_filter.uri_prefix is not None and uri_key(row_filter.uri_prefix) != row_filter.uri_prefix:
+            found.append(self.uris.get(uri_key(row_filter.uri_prefix), ()))
+        return min(found, key=len) if len(found) > 0 else None
+
+    def query(self, row_filter, limit=100):
+        """
+        the newest rows matching the filter, newest first. the scan stops at the first row received before since
+        """
+        seqs = self.candidates(row_filter)
+        seqs = range(self.next - 1, -1, -1) if seqs is None else reversed(seqs)
+        oldest = self.oldest()
+        result = []
+        for seq in seqs:
+            if seq < oldest or len(result) >= limit:
+                break
+            row = self.rows[seq % self.size]
+            if row_filter.since is not None and row[TIME] < row_filter.since:
+                break
+            if row_filter.match(row):
+                result.append(row)
+        return result
+
+    def subscribe(self, row_filter):
+        subscriber = Subscriber(row_filter)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import math
+import struct
+import time
+
+# columns of the rollup table, one row per (minute, host, request_uri), request_uri '' is the host total
+# and requests with an empty request_uri are counted under '-'
+ROLLUP_COLUMNS = ('minute', 'host', 'request_uri', 'requests', 'status_1xx', 'status_2xx', 'status_3xx', 'status_4xx',
+                  'status_5xx', 'bytes', 'request_time_p50', 'request_time_p95', 'request_time_p99',
+                  'request_time_max', 'upstream_response_time_p50', 'upstream_response_time_p95',
+                  'upstream_response_time_p99', 'request_time_sketch', 'upstream_response_time_sketch')
+# URIs of a minute beyond ROLLUP_MAX_URIS are counted under this one
+OTHER_URI = '(other)'
+
+# 1% relative accuracy: a value v falls in bucket ceil(log(v, GAMMA)), every bucket spans 2% of its values
+ACCURACY = 0.01
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# request times are logged in milliseconds, anything below counts as zero
+MIN_VALUE = 0.0005
+BIN = struct.Struct('!hI')
+
+bucket_cache = {}
+
+
+def bucket(value):
+    """
+    bucket index of a '0.041' style time, None for zero or unparsable values.
+    the same few thousand strings repeat all day so the index is cached
+    """
+    index = bucket_cache.get(value)
+    if index is None:
+        if len(bucket_cache) >= 65536:
+            bucket_cache.clear()
+        try:
+            seconds = float(str(value).partition(',')[0])
+            index = math.ceil(math.log(seconds) / LOG_GAMMA) if seconds >= MIN_VALUE else 0x7fff
+        except ValueError:
+            index = 0x7fff
+        bucket_cache[value] = index
+    return None if index == 0x7fff else index
+
+
+class Sketch:
+    """
+    mergeable log-bucket quantile sketch: quantiles are within ACCURACY of the exact value and two sketches
+    merge by adding their bucket counts, so partial rows of the same minute can be combined exactly
+    """
+
+    __slots__ = ('bins', 'zeros', 'count')
+
+    def __init__(self):
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, index):
+        self.count += 1
+        if index is None:
+            self.zeros += 1
+        else:
+            self.bins[index] = self.bins.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return round(2 * GAMMA ** index / (GAMMA + 1), 3)
+        return round(2 * GAMMA ** max(self.bins) / (GAMMA + 1), 3)
+
+    def max(self):
+        return round(GAMMA ** max(self.bins), 3) if len(self.bins) > 0 else 0
+
+    def dumps(self):
+        """
+        zero count followed by (bucket, count) pairs
+        """
+        return struct.pack('!I', self.zeros) + b''.join(BIN.pack(index, count) for index, count in self.bins.items())
+
+    @classmethod
+    def loads(cls, data):
+        sketch = cls()
+        sketch.zeros = sketch.count = struct.unpack_from('!I', data)[0]
+        for index, count in BIN.iter_unpack(data[4:]):
+            sketch.bins[index] = count
+            sketch.count += count
+        return sketch
+
+
+class Aggregate:
+    __slots__ = ('requests', 'statuses', 'bytes', 'request_time', 'upstream_response_time')
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = [0] * 6
+        self.bytes = 0
+        self.request_time = Sketch()
+        self.upstream_response_time = Sketch()
+
+    def add(self, status_class, size, request_time, upstream_response_time):
+        self.requests += 1
+        self.statuses[status_class] += 1
+        self.bytes += size
+        self.request_time.add(request_time)
+        if upstream_response_time is not False:
+            self.upstream_response_time.add(upstream_response_time)
+
+    def row(self, minute, host, uri):
+        return (minute + ':00', host, uri, self.requests, *self.statuses[1:6], self.bytes,
+                self.request_time.quantile(0.5), self.request_time.quantile(0.95),
+                self.request_time.quantile(0.99), self.request_time.max(),
+                self.upstream_response_time.quantile(0.5), self.upstream_response_time.quantile(0.95),
+                self.upstream_response_time.quantile(0.99), self.request_time.dumps(),
+                self.upstream_response_time.dumps())
+
+
+class Rollup:
+    """
+    per-minute aggregates of committed access log rows, per host and per (host, request_uri).
+    at most max_uris URIs are tracked per minute, the rest are folded into OTHER_URI
+    """
+
+    def __init__(self, max_uris=1000, delay=60):
+        self.max_uris = max_uris
+        self.delay = delay
+        # minute -> {(host, uri): Aggregate}
+        self.minutes = {}
+        self.uri_counts = {}
+
+    def add(self, row):
+        """
+        row is a parse_log tuple in LOG_COLUMNS order
+        """
+        minute = row[0][0:16]
+        aggregates = self.minutes.get(minute)
+        if aggregates is None:
+            aggregates = self.minutes[minute] = {}
+            self.uri_counts[minute] = 0
+        host = row[1]
+        uri = row[3] or '-'
+        try:
+            status = int(row[7])
+        except ValueError:
+            status = 0
+        status_class = status // 100 if 100 <= status < 600 else 0
+        try:
+            size = int(row[8])
+        except ValueError:
+            size = 0
+        request_time = bucket(row[13])
+        # requests served without an upstream have no upstream response time
+        upstream_response_time = bucket(row[12]) if row[11] not in (0, '0', '') else False
+        total = aggregates.get((host, None))
+        if total is None:
+            total = aggregates[(host, None)] = Aggregate()
+        total.add(status_class, size, request_time, upstream_response_time)
+        aggregate = aggregates.get((host, uri))
+        if aggregate is None:
+            if self.uri_counts[minute] >= self.max_uris:
+                uri = OTHER_URI
+                aggregate = aggregates.get((host, uri))
+            if aggregate is None:
+                aggregate = aggregates[(host, uri)] = Aggregate()
+                self.uri_counts[minute] += 1
+        aggregate.add(status_class, size, request_time, upstream_response_time)
+
+    def close(self, now=None):
+        """
+        pop the minutes that ended more than delay seconds ago, or every minute when now is None.
+        return their rows in ROLLUP_COLUMNS order.
+        rows arriving later for a closed minute start a new partial aggregate, whose row is flushed on its own
+        """
+        if now is None:
+            closed = list(self.minutes)
+        else:
+            current = time.strftime('%Y-%m-%d %H:%M', time.localtime(now - self.delay))
+            closed = [minute for minute in self.minutes if minute < current]
+        rows = []
+        for minute in sorted(closed):
+            for (host, uri), aggregate in self.minutes.pop(minute).items():
+                rows.append(aggregate.row(minute, host, '' if uri is None else uri))
+            del self.uri_counts[minute]
+        return rows
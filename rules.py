@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import json
+import logging
+import re
+import threading
+import zlib
+
+import logparse
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class Rule:
+    """
+    the conditions of a rule must all match. action drop drops the matching lines, sample keeps 1 in rate
+    of them, picked by a checksum of the line so the same line is always kept or dropped
+    """
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.action = spec.get('action', 'drop')
+        if self.action not in ('drop', 'sample'):
+            raise ValueError('rule %s: unknown action %s' % (self.name, self.action))
+        if self.action == 'sample' and 'rate' not in spec:
+            raise ValueError('rule %s: sample needs a rate' % self.name)
+        self.rate = int(spec.get('rate', 1))
+        if self.rate < 1:
+            raise ValueError('rule %s: rate must be 1 or more' % self.name)
+        self.uri_prefixes = tuple(as_list(spec.get('uri_prefix')))
+        self.uri_regex = re.compile(spec['uri_regex']) if spec.get('uri_regex') else None
+        self.statuses = frozenset(int(status) for status in as_list(spec.get('status')))
+        self.user_agents = tuple(as_list(spec.get('user_agent')))
+        self.user_agent_regex = re.compile(spec['user_agent_regex']) if spec.get('user_agent_regex') else None
+        self.hits = 0
+        self.dropped = 0
+
+    def match(self, uri, status, user_agent):
+        if self.uri_prefixes and not uri.startswith(self.uri_prefixes):
+            return False
+        if self.uri_regex is not None and self.uri_regex.search(uri) is None:
+            return False
+        if self.statuses and status not in self.statuses:
+            return False
+        if self.user_agents and not any(agent in user_agent for agent in self.user_agents):
+            return False
+        if self.user_agent_regex is not None and self.user_agent_regex.search(user_agent) is None:
+            return False
+        return True
+
+    def keep(self, line):
+        return self.action == 'sample' and zlib.crc32(line) % self.rate == 0
+
+
+class RuleSet:
+    """
+    the first matching rule decides, lines matching no rule are kept.
+    lines with a status of keep_status or above are always kept
+    """
+
+    def __init__(self, rules, keep_status=500):
+        self.rules = rules
+        self.keep_status = keep_status
+        self.lock = threading.Lock()
+
+    def filter(self, chunk):
+        """
+        return the kept lines of a chunk of access log lines, b'' when all are dropped
+        """
+        kept = []
+        hits = [0] * len(self.rules)
+        dropped = [0] * len(self.rules)
+        for line in chunk.split(b'\n'):
+            if not line:
+                continue
+            try:
+                raw_json = logparse.loads(line)
+                status = int(raw_json.get('status') or 0)
+                uri = logparse.split_request(raw_json.get('request', ''))[1]
+                user_agent = raw_json.get('http_user_agent', '')
+            except Exception:
+                # malformed lines are left to the server to report
+                kept.append(line)
+                continue
+            if self.keep_status is not None and status >= self.keep_status:
+                kept.append(line)
+                continue
+            for i, rule in enumerate(self.rules):
+                if rule.match(uri, status, user_agent):
+                    hits[i] += 1
+                    if rule.keep(line):
+                        kept.append(line)
+                    else:
+                        dropped[i] += 1
+                    break
+            else:
+                kept.append(line)
+        # the tailer threads filter in parallel
+        with self.lock:
+            for i, rule in enumerate(self.rules):
+                rule.hits += hits[i]
+                rule.dropped += dropped[i]
+        if len(kept) == 0:
+            return b''
+        kept.append(b'')
+        return b'\n'.join(kept)
+
+    def stats(self):
+        """
+        {rule name: (hits, dropped)}
+        """
+        with self.lock:
+            return {rule.name: (rule.hits, rule.dropped) for rule in self.rules}
+
+
+def load(file):
+    """
+    {"keep_status": 500, "rules": [{"name": "health", "uri_prefix": ["/health"]}, ...]}.
+    return None when file is empty or the rules are invalid
+    """
+    if not file:
+        return None
+    try:
+        with open(file) as f:
+            spec = json.load(f)
+        return RuleSet([Rule(rule) for rule in spec.get('rules', [])], spec.get('keep_status', 500))
+    except Exception as e:
+        logging.warning('load rules %s failed: %s', file, repr(e))
+        return None
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import struct
+import time
+import zlib
+
+import websockets
+
+import logparse
+import metrics
+import protocol
+
+frames_sent = metrics.Counter('logbeat_frames_sent_total', 'frames sent, including frames sent again')
+lines_sent = metrics.Counter('logbeat_lines_sent_total', 'log lines sent, including lines sent again')
+bytes_sent = metrics.Counter('logbeat_sent_bytes_total', 'bytes of frames sent')
+reconnects = metrics.Counter('logbeat_reconnects_total', 'websocket connections opened after the first')
+endpoint_failures = metrics.Counter('logbeat_endpoint_failures_total', 'failed connections to a server endpoint',
+                                    labels=('endpoint',))
+parse_errors = metrics.Counter('logbeat_parse_errors_total', 'log lines that failed to parse into rows')
+ack_seconds = metrics.Histogram('logbeat_ack_seconds', 'seconds from first sending a batch to its acknowledgement')
+
+# longest backoff of a failed endpoint in seconds
+MAX_BACKOFF = 60
+# a connection up this many seconds resets the backoff of its endpoint
+HEALTHY_SECONDS = 10
+
+
+class Checkpoint:
+    """
+    per-file (inode, offset) of the data the server has acknowledged, persisted as {path: [inode, offset]}
+    """
+
+    def __init__(self, file, interval=1):
+        self.file = file
+        self.interval = interval
+        self.offsets = {}
+        self.saved_at = 0
+        self.dirty = False
+        try:
+            with open(file) as f:
+                self.offsets = {path: tuple(value) for path, value in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning('load checkpoint %s failed: %s', file, repr(e))
+
+    def get(self, path, ino):
+        value = self.offsets.get(path)
+        if value is not None and value[0] == ino:
+            return value[1]
+        return None
+
+    def update(self, path, ino, offset):
+        self.offsets[path] = (ino, offset)
+        self.dirty = True
+
+    def save(self, force=False):
+        if not self.dirty or (not force and time.time() - self.saved_at < self.interval):
+            return
+        tmp_file = self.file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.offsets, f)
+            os.replace(tmp_file, self.file)
+            self.saved_at = time.time()
+            self.dirty = False
+        except Exception as e:
+            logging.warning('save checkpoint %s failed: %s', self.file, repr(e))
+
+
+class MemoryQueue(asyncio.Queue):
+    """
+    queue of (chunk, mark) items holding up to max_bytes of chunks, put blocks while it is full.
+    an item is taken while the queue holds less than max_bytes, so a queue can exceed it by one chunk
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        super().__init__()
+
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+        self.queued_bytes = 0
+
+    def full(self):
+        return self.queued_bytes >= self.max_bytes
+
+    def _put(self, item):
+        self._queue.append(item)
+        self.queued_bytes += len(item[0])
+
+    def _get(self):
+        item = self._queue.popleft()
+        self.queued_bytes -= len(item[0])
+        return item
+
+
+class SpillQueue(asyncio.Queue):
+    """
+    queue of (chunk, mark) items that keeps up to memory_bytes of chunks in memory and appends the rest to
+    zlib compressed segment files of segment_bytes in directory, which are read back in order.
+    put only blocks once max_bytes of segments are on disk.
+    close writes the unacknowledged items in front of the segments and the (inode, offset) of the last item
+    put per file into the watermark, a restart sends the segments first and resumes tailing from the watermark
+    """
+
+    RECORD = struct.Struct('!II')
+
+    def __init__(self, directory, memory_bytes=64 << 20, max_bytes=1 << 30, segment_bytes=64 << 20):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.watermark = Checkpoint(os.path.join(directory, 'watermark.json'))
+        # a watermark left by a crash would skip the items that were only in memory
+        self.watermark.dirty = True
+        try:
+            os.unlink(self.watermark.file)
+        except FileNotFoundError:
+            pass
+        super().__init__()
+        # spilled items are sent and acknowledged like the ones put after the start
+        self._unfinished_tasks = self.disk_items
+        if self.disk_items > 0:
+            self._finished.clear()
+
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+        self.queued_bytes = 0
+        self.segments = collections.deque(sorted(int(name[0:-4]) for name in os.listdir(self.directory)
+                                                 if name.endswith('.seg')))
+        self.disk_items = 0
+        self.disk_bytes = 0
+        for segment in self.segments:
+            with open(self.segment_file(segment), 'r+b') as f:
+                size = os.fstat(f.fileno()).st_size
+                end = 0
+                while True:
+                    header = f.read(self.RECORD.size)
+                    if len(header) < self.RECORD.size:
+                        break
+                    if f.seek(sum(self.RECORD.unpack(header)), os.SEEK_CUR) > size:
+                        break
+                    end = f.tell()
+                    self.disk_items += 1
+                # a record cut off by a crash is dropped, the reader stops at the end of the last whole one
+                if end < size:
+                    logging.warning('drop %d bytes of a record cut off at the end of %s', size - end, f.name)
+                    f.truncate(end)
+                self.disk_bytes += end
+        if self.disk_items > 0:
+            logging.warning('%d items spilled to %s are sent first', self.disk_items, self.directory)
+        self.writer = None
+        self.reader = None
+
+    def segment_file(self, segment):
+        return os.path.join(self.directory, '%012d.seg' % segment)
+
+    def qsize(self):
+        return len(self._queue) + self.disk_items
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.disk_bytes >= self.max_bytes
+
+    def _put(self, item):
+        chunk, mark = item
+        if mark is not None:
+            self.watermark.offsets[mark[0]] = mark[1:]
+        # once items are on disk the newer ones follow them there, so items come out in order
+        if self.disk_items == 0 and self.queued_bytes + len(chunk) <= self.memory_bytes:
+            self._queue.append(item)
+            self.queued_bytes += len(chunk)
+            return
+        if self.writer is None or self.writer.tell() >= self.segment_bytes:
+            if self.writer is not None:
+                self.writer.close()
+            segment = self.segments[-1] + 1 if len(self.segments) > 0 else 1 << 32
+            self.segments.append(segment)
+            self.writer = open(self.segment_file(segment), 'ab')
+        self.disk_bytes += self.write_record(self.writer, chunk, mark)
+        # the reader may be at the end of this segment
+        self.writer.flush()
+        self.disk_items += 1
+
+    def write_record(self, f, chunk, mark):
+        mark = json.dumps(mark).encode('utf-8') if mark is not None else b''
+        data = zlib.compress(chunk, 1)
+        f.write(self.RECORD.pack(len(mark), len(data)) + mark + data)
+        return self.RECORD.size + len(mark) + len(data)
+
+    def _get(self):
+        if len(self._queue) > 0:
+            item = self._queue.popleft()
+            self.queued_bytes -= len(item[0])
+            return item
+        while True:
+            if self.reader is None:
+                self.reader = open(self.segment_file(self.segments[0]), 'rb')
+            header = self.reader.read(self.RECORD.size)
+            if len(header) == self.RECORD.size:
+                break
+            # a segment is removed once it has been read to the end
+            self.disk_bytes -= self.reader.tell()
+            self.reader.close()
+            self.reader = None
+            os.unlink(self.segment_file(self.segments.popleft()))
+        mark_size, data_size = self.RECORD.unpack(header)
+        mark = self.reader.read(mark_size)
+        item = (zlib.decompress(self.reader.read(data_size)), tuple(json.loads(mark)) if mark_size else None)
+        self.disk_items -= 1
+        if self.disk_items == 0:
+            self.reader.close()
+            self.reader = None
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            for segment in self.segments:
+                os.unlink(self.segment_file(segment))
+            self.segments.clear()
+            self.disk_bytes = 0
+        return item
+
+    def close(self, inflight):
+        """
+        write the in-flight batches and the items still in memory to a segment in front of the others,
+        then save the watermark
+        """
+        items = [item for batch in inflight.values() for item in batch] + list(self._queue)
+        inflight.clear()
+        self._queue.clear()
+        segment = self.segments[0] - 1 if len(self.segments) > 0 else 1 << 32
+        if self.writer is not None:
+            self.writer.close()
+        rest = b''
+        if self.reader is not None:
+            # the records already read are in items, the partly read segment is replaced by the new one
+            rest = self.reader.read()
+            self.reader.close()
+            os.unlink(self.segment_file(self.segments.popleft()))
+        if len(items) > 0 or len(rest) > 0:
+            with open(self.segment_file(segment), 'wb') as f:
+                for chunk, mark in items:
+                    self.write_record(f, chunk, mark)
+                f.write(rest)
+        self.watermark.save(True)
+
+
+def create_queue(directory, config):
+    """
+    spill to directory when it is set, else buffer up to SPILL_MEMORY_BYTES in memory only
+    """
+    if not directory:
+        return MemoryQueue(int(config.get('SPILL_MEMORY_BYTES') or 64 << 20))
+    return SpillQueue(directory, int(config.get('SPILL_MEMORY_BYTES') or 64 << 20),
+                      int(config.get('SPILL_MAX_BYTES') or 1 << 30), int(config.get('SPILL_SEGMENT_BYTES') or 64 << 20))
+
+
+def spilled_offsets(queue):
+    """
+    {inode: offset} after the last item spilled before the last clean shutdown
+    """
+    if not isinstance(queue, SpillQueue):
+        return {}
+    return {ino: offset for ino, offset in queue.watermark.offsets.values()}
+
+
+async def shutdown(queue, send_task, inflight, timeout):
+    """
+    wait for the queued items to be acknowledged, a spill queue gives up after timeout seconds and keeps the rest
+    on disk for the next start
+    """
+    if isinstance(queue, SpillQueue):
+        try:
+            await asyncio.wait_for(queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning('%d items are not acknowledged, spill them to %s', queue.qsize(), queue.directory)
+        send_task.cancel()
+        try:
+            await send_task
+        except asyncio.CancelledError:
+            pass
+        queue.close(inflight)
+    else:
+        await queue.join()
+        send_task.cancel()
+
+
+async def get_batch(queue, max_lines, max_wait, max_bytes=4 << 20):
+    """
+    wait for one item, then keep collecting until max_lines lines, max_bytes bytes or max_wait seconds.
+    a batch can exceed max_bytes by one chunk
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    lines = batch[0][0].count(b'\n')
+    size = len(batch[0][0])
+    deadline = loop.time() + max_wait
+    while lines < max_lines and size < max_bytes:
+        if not queue.empty():
+            item = queue.get_nowait()
+        else:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        batch.append(item)
+        lines += item[0].count(b'\n')
+        size += len(item[0])
+    return batch
+
+
+async def receive_ack(websocket, queue, inflight, checkpoint, acked, sent_at):
+    """
+    acks are cumulative: every batch up to the acknowledged sequence is committed on the server
+    """
+    try:
+        async for message in websocket:
+            seq = protocol.unpack_ack(message)
+            now = time.time()
+            while len(inflight) > 0 and next(iter(inflight)) <= seq:
+                batch_seq, batch = inflight.popitem(last=False)
+                ack_seconds.observe(now - sent_at.pop(batch_seq, now))
+                for _, mark in batch:
+                    if mark is not None:
+                        checkpoint.update(*mark)
+                    queue.task_done()
+            checkpoint.save()
+            acked.set()
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        acked.set()
+
+
+def pack_rows(encoder, chunks, codec, seq):
+    """
+    parse the lines of chunks and pack the rows, lines that fail to parse are logged and left out
+    """
+    lines = [line for chunk in chunks for line in chunk.decode('utf-8', errors='ignore').split('\n') if line]
+    kinds, errors = logparse.parse_lines(lines)
+    parse_errors.inc(errors)
+    return encoder.pack(kinds, codec, seq)
+
+
+async def send_batch(websocket, batch, codec, seq, sent_at, encoder=None):
+    """
+    send the batch as a frame of lines, or of rows when the connection has an encoder
+    """
+    chunks = [chunk for chunk, _ in batch]
+    if encoder is None:
+        frame = protocol.pack_lines(chunks, codec, seq)
+    else:
+        # frames of a connection are packed one at a time, in the order they are sent
+        frame = await asyncio.get_running_loop().run_in_executor(None, pack_rows, encoder, chunks, codec, seq)
+    sent_at.setdefault(seq, time.time())
+    await websocket.send(frame)
+    frames_sent.inc()
+    lines_sent.inc(sum(chunk.count(b'\n') for chunk, _ in batch))
+    bytes_sent.inc(len(frame))
+
+
+def endpoint_uris(config):
+    """
+    WS_ENDPOINTS is a comma separated list of host:port, WS_HOST:WS_PORT when it is empty
+    """
+    endpoints = config.get('WS_ENDPOINTS') or config['WS_HOST'] + ':' + config['WS_PORT']
+    return ["ws://" + config['WS_USER'] + ':' + config['WS_PASS'] + '@' + endpoint.strip()
+            for endpoint in endpoints.split(',') if endpoint.strip()]
+
+
+class Endpoints:
+    """
+    the servers of a client. every client starts at a random endpoint to spread the clients over the servers,
+    stays on it while it works and fails over to the next one. an endpoint that failed is skipped for a backoff
+    doubling from 1 up to MAX_BACKOFF seconds with every failure in a row
+    """
+
+    def __init__(self, uris):
+        self.uris = uris
+        self.current = random.randrange(len(uris))
+        self.failures = [0] * len(uris)
+        self.retry_at = [0] * len(uris)
+
+    def name(self, index):
+        # host:port without the credentials
+        return self.uris[index].rpartition('@')[2]
+
+    def next(self):
+        """
+        (index, seconds to wait) of the endpoint to connect to
+        """
+        now = time.time()
+        order = [(self.current + i) % len(self.uris) for i in range(len(self.uris))]
+        for index in order:
+            if self.retry_at[index] <= now:
+                return index, 0
+        index = min(order, key=lambda i: self.retry_at[i])
+        return index, self.retry_at[index] - now
+
+    def failed(self, index):
+        self.failures[index] += 1
+        self.retry_at[index] = time.time() + min(MAX_BACKOFF, 2 ** (self.failures[index] - 1))
+        self.current = (index + 1) % len(self.uris)
+        endpoint_failures.inc(labels=(self.name(index),))
+
+    def succeeded(self, index):
+        self.failures[index] = 0
+        self.current = index
+
+
+async def send_log(uris, queue, checkpoint, config, inflight=None, **kwargs):
+    """
+    queue items are (chunk, mark), chunk is bytes of complete lines and mark is (path, inode, offset) after
+    the chunk or None.
+    batches stay in inflight until acknowledged and are sent again after a reconnection, to the same server or
+    the next one of uris when it failed or did not acknowledge anything for WS_ACK_TIMEOUT seconds.
+    WS_PROTOCOL rows parses the lines here and sends rows, every connection starts a new dictionary so batches
+    sent again are packed again
+    """
+    codec = protocol.get_codec(config.get('WS_COMPRESSION'))
+    send_rows = (config.get('WS_PROTOCOL') or 'lines') == 'rows'
+    max_lines = int(config.get('WS_BATCH_LINES') or 500)
+    max_wait = int(config.get('WS_BATCH_MS') or 200) / 1000
+    max_bytes = int(config.get('WS_BATCH_BYTES') or 4 << 20)
+    window = int(config.get('WS_ACK_WINDOW') or 32)
+    ack_timeout = float(config.get('WS_ACK_TIMEOUT') or 60)
+    if inflight is None:
+        inflight = collections.OrderedDict()
+    acked = asyncio.Event()
+    sent_at = {}
+    seq = 0
+    connected = False
+    endpoints = Endpoints(uris)
+    # a server applying backpressure stops reading, including pings, so keepalive must not time out
+    kwargs.setdefault('ping_timeout', None)
+    while True:
+        index, delay = endpoints.next()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            websocket = await websockets.connect(
+                endpoints.uris[index], compression=protocol.ws_compression(config.get('WS_COMPRESSION')), **kwargs)
+        except Exception as e:
+            logging.warning('connect %s failed: %s', endpoints.name(index), repr(e))
+            endpoints.failed(index)
+            continue
+        if connected:
+            reconnects.inc()
+        connected = True
+        connected_at = time.time()
+        timed_out = False
+        encoder = protocol.RowEncoder() if send_rows else None
+        ack_task = asyncio.create_task(receive_ack(websocket, queue, inflight, checkpoint, acked, sent_at))
+        try:
+            for batch_seq, batch in list(inflight.items()):
+                await send_batch(websocket, batch, codec, batch_seq, sent_at, encoder)
+            while websocket.open:
+                while len(inflight) >= window and websocket.open:
+                    acked.clear()
+                    await asyncio.wait_for(acked.wait(), ack_timeout)
+                if not websocket.open:
+                    break
+                batch = await get_batch(queue, max_lines, max_wait, max_bytes)
+                seq += 1
+                inflight[seq] = batch
+                await send_batch(websocket, batch, codec, seq, sent_at, encoder)
+        except asyncio.TimeoutError:
+            logging.warning('%s acknowledged nothing for %.0fs', endpoints.name(index), ack_timeout)
+            timed_out = True
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            logging.warning(repr(e), exc_info=True)
+        finally:
+            ack_task.cancel()
+            checkpoint.save(True)
+        # a server that closes connections soon after accepting them is failed over like one that refuses them
+        if not timed_out and time.time() - connected_at >= HEALTHY_SECONDS:
+            endpoints.succeeded(index)
+        else:
+            endpoints.failed(index)
+        await websocket.close()
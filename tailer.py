@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import os
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class FileTailer:
+    """
+    read what is appended to a log in large binary chunks. only complete lines are returned,
+    a trailing partial line is carried over to the next read
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.name = path
+        self.file = open(path, 'rb', buffering=0)
+        self.ino = os.fstat(self.file.fileno()).st_ino
+        self.buffer = bytearray(chunk_size)
+        self.view = memoryview(self.buffer)
+        self.partial = b''
+        # position after the last complete line returned
+        self.offset = 0
+        # time the path was found to name another file or none, the tailer then only drains this file
+        self.rotated_at = None
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self.offset = offset
+        self.partial = b''
+
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def lag(self):
+        """
+        bytes written to the file but not returned yet
+        """
+        return self.size() - self.offset
+
+    def read(self):
+        """
+        return the complete lines of the next chunk, b'' at EOF
+        """
+        while True:
+            n = self.file.readinto(self.buffer)
+            if not n:
+                return b''
+            end = self.buffer.rfind(b'\n', 0, n)
+            if end < 0:
+                self.partial += self.view[:n]
+                continue
+            chunk = self.partial + self.view[:end + 1] if self.partial else bytes(self.view[:end + 1])
+            self.partial = bytes(self.view[end + 1:n])
+            self.offset += len(chunk)
+            return chunk
+
+    def flush(self):
+        """
+        return the trailing partial line as a complete one, b'' when there is none
+        """
+        chunk = self.partial + b'\n' if self.partial else b''
+        self.offset += len(self.partial)
+        self.partial = b''
+        return chunk
+
+    def at_end(self):
+        """
+        whether everything written to the file was read, a trailing partial line included
+        """
+        return self.file.tell() >= self.size()
+
+    def rotation(self):
+        """
+        'moved' when the path was renamed or removed (nginx style rotation), 'truncated' when the file is shorter
+        than what was read (copytruncate), else None
+        """
+        try:
+            ino = os.stat(self.name).st_ino
+        except FileNotFoundError:
+            return 'moved'
+        if ino != self.ino:
+            return 'moved'
+        if self.size() < self.file.tell():
+            return 'truncated'
+        return None
+
+    def mark(self):
+        """
+        checkpoint position after the last line returned, None once the path names another file
+        """
+        if self.rotated_at is not None:
+            return None
+        return self.name, self.ino, self.offset
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,263 @@
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from dotenv import dotenv_values
+
+import loadgen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_env(file, values):
+    with open(file, 'w') as f:
+        for key, value in values.items():
+            f.write('%s=%s\n' % (key, '' if value is None else value))
+
+
+def scrape(port, name):
+    """
+    sum of the samples of a metric, None while the endpoint is not up
+    """
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % port, timeout=1) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    total = 0
+    for line in text.splitlines():
+        if line.startswith(name + ' ') or line.startswith(name + '{'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, ValueError, IndexError):
+                pass
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+    return pids
+
+
+def process_usage(pid):
+    """
+    (cpu seconds, rss bytes) of a process
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    with open('/proc/%d/statm' % pid) as f:
+        rss_pages = int(f.read().split()[1])
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class Sampler(threading.Thread):
+    """
+    sample the rows written by every sink of the server and the cpu and rss of every process tree
+    """
+
+    def __init__(self, metrics_ports, sinks, processes, interval=0.05):
+        super().__init__(daemon=True)
+        self.metrics_ports = metrics_ports
+        self.sinks = sinks
+        self.processes = processes
+        self.interval = interval
+        self.inserted = []
+        self.cpu = {name: {} for name in processes}
+        self.rss = {name: 0 for name in processes}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            # every server worker has its own endpoint, a row counts once all sinks have written it
+            rows = [[scrape(port, 'logbeat_sink_rows_total{sink="%s"}' % sink) for port in self.metrics_ports]
+                    for sink in self.sinks]
+            if all(None not in sink_rows for sink_rows in rows):
+                self.inserted.append((time.time(), min(sum(sink_rows) for sink_rows in rows)))
+            for name, process in self.processes.items():
+                rss = 0
+                for pid in process_tree(process.pid):
+                    try:
+                        self.cpu[name][pid], pid_rss = process_usage(pid)
+                        rss += pid_rss
+                    except (OSError, ValueError, IndexError):
+                        pass
+                self.rss[name] = max(self.rss[name], rss)
+
+    def rows(self):
+        return self.inserted[-1][1] if len(self.inserted) > 0 else 0
+
+
+def wait_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while scrape(port, 'logbeat_') is None:
+        if time.time() > deadline:
+            raise RuntimeError('metrics endpoint on port %d is not up' % port)
+        time.sleep(0.1)
+
+
+def start(script, env_file, log_file):
+    env = dict(os.environ, LOGBEAT_ENV=env_file)
+    return subprocess.Popen([sys.executable, script], cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def latencies(timeline, inserted):
+    """
+    for every point of the write timeline, seconds until the server had committed as many rows
+    """
+    result = []
+    i = 0
+    for written_at, written in timeline:
+        while i < len(inserted) and inserted[i][1] < written:
+            i += 1
+        if i == len(inserted):
+            break
+        result.append(max(0, inserted[i][0] - written_at))
+    return sorted(result)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if len(values) > 0 else float('nan')
+
+
+def bench(args, work_dir):
+    ws_port = free_port()
+    server_metrics = free_port()
+    client_metrics = free_port()
+    common = {'WS_HOST': '127.0.0.1', 'WS_PORT': ws_port, 'WS_USER': 'bench', 'WS_PASS': 'bench',
+              'LOG_LEVEL': 'warning', 'METRICS_HOST': '127.0.0.1', 'WS_COMPRESSION': args.compression,
+              'WS_PROTOCOL': args.protocol}
+    if args.mysql:
+        server_env = dict(dotenv_values(args.mysql))
+    else:
+        server_env = {'WRITE_MODE': 'null', 'DB_NAME': 'bench', 'DB_PREFIX': 'bench_'}
+    server_env.update(common, LOG_FILE=os.path.join(work_dir, 'server.log'), METRICS_PORT=server_metrics,
+                      PARSE_WORKERS=args.parse_workers, SERVER_WORKERS=args.server_workers, SINKS=args.sinks,
+                      ARCHIVE_DIR=os.path.join(work_dir, 'archive'))
+    access_log = os.path.join(work_dir, 'access.log')
+    slow_log = os.path.join(work_dir, 'slow.log')
+    client_env = dict(common, LOG_FILE=os.path.join(work_dir, 'client.log'), METRICS_PORT=client_metrics,
+                      WATCH_LOG=access_log, CHECKPOINT_FILE=os.path.join(work_dir, 'checkpoint.json'),
+                      SPILL_DIR=os.path.join(work_dir, 'spill'), SLOW_LOG=slow_log, SLOW_LOG_OFFSET=0,
+                      SLOW_CHECKPOINT_FILE=os.path.join(work_dir, 'slow_checkpoint.json'),
+                      SLOW_SPILL_DIR=os.path.join(work_dir, 'slow_spill'), SLOW_METRICS_PORT=free_port())
+    for name, values in (('server.env', server_env), ('client.env', client_env)):
+        write_env(os.path.join(work_dir, name), values)
+
+    writers = [loadgen.LogWriter(access_log, loadgen.access_line, args.rate)]
+    if args.slow_rate > 0:
+        writers.append(loadgen.LogWriter(slow_log, loadgen.slow_entry, args.slow_rate, 1))
+    output = open(os.path.join(work_dir, 'output.log'), 'w')
+    processes = {'server': start('logbeat_server.py', os.path.join(work_dir, 'server.env'), output)}
+    server_ports = [server_metrics + i for i in range(args.server_workers)]
+    for port in server_ports:
+        wait_port(port)
+    processes['client'] = start('logbeat_client.py', os.path.join(work_dir, 'client.env'), output)
+    if args.slow_rate > 0:
+        processes['slow client'] = start('logbeat_slow_client.py', os.path.join(work_dir, 'client.env'), output)
+    wait_port(client_metrics)
+    if args.slow_rate > 0:
+        wait_port(client_env['SLOW_METRICS_PORT'])
+    sampler = Sampler(server_ports, [sink.strip() for sink in args.sinks.split(',')], processes)
+    sampler.start()
+
+    rotations = []
+
+    def on_tick(elapsed):
+        if args.scenario != 'steady' and elapsed >= args.rotate_every * (len(rotations) + 1):
+            rotations.append(writers[0].rotate(args.scenario))
+
+    started = time.time()
+    timeline = loadgen.run(writers, args.seconds, on_tick=on_tick,
+                           backlog=lambda: sum(writer.written for writer in writers) - sampler.rows())
+    written = timeline[-1][1]
+    deadline = time.time() + args.drain_timeout
+    while sampler.rows() < written and time.time() < deadline:
+        time.sleep(0.1)
+    finished = sampler.inserted[-1][0] if len(sampler.inserted) > 0 else time.time()
+    inserted = sampler.rows()
+    sampler.stopped.set()
+    sampler.join()
+    client_ports = [client_metrics] + ([client_env['SLOW_METRICS_PORT']] if args.slow_rate > 0 else [])
+    sent_bytes = sum(scrape(port, 'logbeat_sent_bytes_total') or 0 for port in client_ports)
+    for name, process in reversed(list(processes.items())):
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(args.stop_timeout)
+        except subprocess.TimeoutExpired:
+            print('%s did not stop within %.0fs after SIGTERM, killed' % (name, args.stop_timeout))
+            process.kill()
+            process.wait()
+    for writer in writers:
+        writer.close()
+
+    waits = latencies(timeline, sampler.inserted)
+    print('scenario %s, %d rotations, %.0fs at %d lines/s (+%d slow entries/s), protocol %s, sinks %s%s'
+          % (args.scenario, len(rotations), args.seconds, args.rate, args.slow_rate, args.protocol, args.sinks,
+             ' (mysql discards the rows)' if 'mysql' in args.sinks and not args.mysql else ''))
+    print('written %d, committed %d, missing %d' % (written, inserted, written - inserted))
+    print('sustained %.0f lines/s, sent %.1f MiB (%.0f bytes/line)'
+          % (inserted / max(finished - started, 1e-9), sent_bytes / (1 << 20), sent_bytes / max(written, 1)))
+    print('end-to-end latency p50 %.3fs p95 %.3fs p99 %.3fs max %.3fs'
+          % (percentile(waits, 0.5), percentile(waits, 0.95), percentile(waits, 0.99), percentile(waits, 1)))
+    wall = finished - started
+    for name in processes:
+        cpu = sum(sampler.cpu[name].values())
+        print('%-11s cpu %.1fs (%.0f%% of a core), max rss %.1f MiB'
+              % (name, cpu, cpu / wall * 100, sampler.rss[name] / (1 << 20)))
+    return written == inserted
+
+
+if __name__ == '__main__':
+    '''
+    run the server and the clients on this box against generated logs and report throughput, latency and usage
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=int, default=10000, help='access log lines per second, 0 for no limit')
+    parser.add_argument('--slow-rate', type=int, default=0, help='slow log entries per second')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--scenario', choices=['steady', 'rename', 'copytruncate'], default='steady')
+    parser.add_argument('--rotate-every', type=float, default=10, help='seconds between rotations')
+    parser.add_argument('--mysql', help='env file with the DB_ settings of a MySQL to write to, '
+                                        'the server discards the rows without it')
+    parser.add_argument('--sinks', default='mysql', help='SINKS of the server, archive writes to the work directory')
+    parser.add_argument('--parse-workers', default='0')
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help='server worker processes, their metrics ports follow the first one')
+    parser.add_argument('--compression', default='deflate')
+    parser.add_argument('--protocol', choices=['lines', 'rows'], default='lines', help='WS_PROTOCOL of the clients')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='seconds to wait for the server to commit everything written')
+    parser.add_argument('--stop-timeout', type=float, default=60,
+                        help='seconds to wait for every process to exit after SIGTERM before killing it')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory with logs and env files')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='logbeat-bench-')
+    try:
+        ok = bench(args, work_dir)
+    finally:
+        if args.keep:
+            print('work directory', work_dir)
+        else:
+            subprocess.run(['rm', '-rf', work_dir])
+    sys.exit(0 if ok else 1)
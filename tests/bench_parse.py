@@ -0,0 +1,52 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logparse  # noqa: E402
+
+SAMPLE_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'access.sample.log')
+
+
+def load_lines(file, count):
+    with open(file) as f:
+        sample = [line for line in f if line.strip()]
+    return (sample * (count // len(sample) + 1))[0:count]
+
+
+def bench(lines):
+    start = time.perf_counter()
+    for line in lines:
+        logparse.parse_log(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def bench_backend(name, lines):
+    logparse.loads = json.loads if name == 'json' else logparse.orjson.loads
+    logparse.time_cache.clear()
+    return bench(lines)
+
+
+if __name__ == '__main__':
+    '''
+    parse_log throughput in lines/sec per core over recorded nginx_log.conf lines
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', default=SAMPLE_LOG)
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+    test_lines = load_lines(args.file, args.lines)
+    backends = ['json'] if logparse.orjson is None else ['json', 'orjson']
+    for backend in backends:
+        if args.processes > 1:
+            with multiprocessing.Pool(args.processes) as pool:
+                rates = pool.starmap(bench_backend, [(backend, test_lines)] * args.processes)
+        else:
+            rates = [bench_backend(backend, test_lines)]
+        print('%-7s %d process(es): %.0f lines/sec per core, %.0f lines/sec total'
+              % (backend, len(rates), sum(rates) / len(rates), sum(rates)))
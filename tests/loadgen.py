@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import time
+
+HOSTS = ['www.example.com', 'api.example.com', 'static.example.com', 'm.example.com']
+URIS = ['/', '/index.php', '/api/v1/orders', '/api/v1/users', '/api/v1/cart', '/search', '/login', '/health',
+        '/static/app.js', '/static/app.css', '/static/logo.png', '/favicon.ico']
+METHODS = ['GET'] * 8 + ['POST'] * 2
+STATUSES = [200] * 80 + [204, 301, 302, 304] * 3 + [400, 403, 404, 404, 499] + [500, 502, 503]
+AGENTS = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0 Safari/537.36',
+          'Mozilla/5.0 (iPhone; CPU iPhone OS 15_5 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+          'python-requests/2.26.0', 'ELB-HealthChecker/2.0', 'curl/7.79.1']
+# unlimited writers write this many entries per tick, and pause while more than UNLIMITED_BACKLOG are unshipped
+UNLIMITED_BATCH = 5000
+UNLIMITED_BACKLOG = 200000
+QUERIES = ["select * from `users` where `id` = {0} limit 1;",
+           "select count(*) from `orders` where `state` = {1} and `created_at` > '2022-08-0{1} 00:00:00';",
+           "update `carts` set `total` = {0}.{1} where `user_id` in ({0}, {1}, {2});",
+           "select `o`.* from `orders` `o` join `users` `u` on `u`.`id` = `o`.`user_id` where `u`.`name` like 'a{2}%';"]
+
+
+def access_line(now, rng):
+    request_time = round(rng.lognormvariate(-3, 1.2), 3)
+    uri = rng.choice(URIS)
+    query = '?id=%d' % rng.randrange(100000) if rng.random() < 0.3 else ''
+    static = uri.startswith('/static') or uri == '/favicon.ico'
+    return json.dumps({
+        '@timestamp': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(now)),
+        'time': '%.3f' % now,
+        'http_host': rng.choice(HOSTS),
+        'clientip': '10.%d.%d.%d' % (rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+        'request': '%s %s%s HTTP/1.1' % (rng.choice(METHODS), uri, query),
+        'status': str(rng.choice(STATUSES)),
+        'size': str(rng.randrange(100, 60000)),
+        'upstream_addr': '' if static else '127.0.0.1:9000',
+        'upstream_status': '' if static else '200',
+        'upstream_response_time': '' if static else '%.3f' % max(0, request_time - 0.001),
+        'request_time': '%.3f' % request_time,
+        'connection_time': '1',
+        'http_referer': 'https://www.example.com/' if rng.random() < 0.5 else '',
+        'http_user_agent': rng.choice(AGENTS),
+        'http_x_forwarded_for': '',
+    }, separators=(',', ':')) + '\n'
+
+
+def slow_entry(now, rng):
+    query_id = rng.randrange(1, 1000000)
+    query = rng.choice(QUERIES).format(rng.randrange(100000), rng.randrange(1, 9), rng.randrange(100))
+    return '# Time: %s\n# User@Host: app[app] @  [192.168.8.%d]  Id: %d\n' \
+           '# Query_time: %.6f  Lock_time: %.6f Rows_sent: %d  Rows_examined: %d\nSET timestamp=%d;\n%s\n' % (
+               time.strftime('%y%m%d %H:%M:%S', time.localtime(now)), rng.randrange(256), query_id,
+               rng.uniform(1, 10), rng.uniform(0, 0.001), rng.randrange(100), rng.randrange(10 ** 7), int(now), query)
+
+
+class LogWriter:
+    """
+    appends rate generated entries per second to path, rate 0 appends as fast as possible.
+    rotate renames or copies and truncates it like logrotate
+    """
+
+    def __init__(self, path, entry, rate, seed=0):
+        self.path = path
+        self.entry = entry
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self.file = open(path, 'a')
+        self.written = 0
+        self.rotations = 0
+        # unlimited rates replay pregenerated entries, generating them is slower than shipping them
+        self.replay = [self.entry(time.time(), self.rng) for _ in range(10000)] if rate == 0 else None
+
+    def write(self, count, now=None):
+        if self.replay is not None:
+            start = self.written % len(self.replay)
+            entries = (self.replay * 2)[start:start + min(count, len(self.replay))]
+            count = len(entries)
+            self.file.write(''.join(entries))
+        else:
+            now = time.time() if now is None else now
+            self.file.write(''.join(self.entry(now, self.rng) for _ in range(count)))
+        self.file.flush()
+        self.written += count
+
+    def rotate(self, mode):
+        """
+        mode rename: move the file away and reopen path, like nginx after USR1.
+        mode copytruncate: copy the file away and truncate it in place
+        """
+        self.rotations += 1
+        rotated = '%s.%d' % (self.path, self.rotations)
+        if mode == 'copytruncate':
+            shutil.copyfile(self.path, rotated)
+            self.file.truncate(0)
+            self.file.seek(0)
+        else:
+            os.rename(self.path, rotated)
+            self.file.close()
+            self.file = open(self.path, 'a')
+        return rotated
+
+    def close(self):
+        self.file.close()
+
+
+def run(writers, seconds, tick=0.01, on_tick=None, backlog=None):
+    """
+    write for seconds, return [(time, entries written by all writers)] sampled every tick.
+    backlog, when given, returns how many written entries are not shipped yet; unlimited writers pause
+    while it is above UNLIMITED_BACKLOG so the log does not grow far beyond what can be shipped
+    """
+    timeline = []
+    started = time.time()
+    while time.time() - started < seconds:
+        elapsed = time.time() - started
+        paused = backlog is not None and backlog() > UNLIMITED_BACKLOG
+        for writer in writers:
+            if writer.rate > 0:
+                due = int(writer.rate * elapsed) - writer.written
+            else:
+                due = 0 if paused else UNLIMITED_BATCH
+            if due > 0:
+                writer.write(due)
+        now = time.time()
+        timeline.append((now, sum(writer.written for writer in writers)))
+        if on_tick is not None:
+            on_tick(now - started)
+        if all(writer.rate > 0 for writer in writers) or paused:
+            time.sleep(max(0, started + len(timeline) * tick - time.time()))
+    return timeline
+
+
+if __name__ == '__main__':
+    '''
+    write synthetic nginx_log.conf access log lines and mysql slow log entries at a fixed rate
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--access', help='access log to write')
+    parser.add_argument('--slow', help='slow log to write')
+    parser.add_argument('--rate', type=int, default=1000, help='access log lines per second, 0 for no limit')
+    parser.add_argument('--slow-rate', type=int, default=10, help='slow log entries per second')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+    log_writers = []
+    if args.access:
+        log_writers.append(LogWriter(args.access, access_line, args.rate))
+    if args.slow:
+        log_writers.append(LogWriter(args.slow, slow_entry, args.slow_rate, 1))
+    points = run(log_writers, args.seconds)
+    print('wrote %d entries in %.1fs' % (points[-1][1], points[-1][0] - points[0][0]))
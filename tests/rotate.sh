@@ -6,5 +6,4 @@ source /usr/local/logbeat/tests/env.conf
 python /usr/local/logbeat/tests/make_requests.py &
 sleep 3
 mv "$MAIN_LOG" "${MAIN_LOG::-4}"-"$(date +%F-%H-%M-%S)".log
-kill -USR1 "$(cat "${NGINX_PID}")"
-kill -USR1 "$(pgrep -f logbeat_client.py)"
\ No newline at end of file
+kill -USR1 "$(cat "${NGINX_PID}")"
\ No newline at end of file
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shipper  # noqa: E402
+
+
+def items(start, count):
+    return [(b'line %d\n' % i, ('access.log', 1, 8 * (i + 1))) for i in range(start, start + count)]
+
+
+def drain(queue):
+    result = []
+    while not queue.empty():
+        result.append(queue.get_nowait())
+        queue.task_done()
+    return result
+
+
+def test_crash_recovery():
+    """
+    a record cut off by a crash is dropped, the whole ones before it are sent and a restart spilling again reads
+    past the cut
+    """
+    async def run(directory):
+        queue = shipper.SpillQueue(directory, memory_bytes=0)
+        for item in items(0, 100):
+            queue.put_nowait(item)
+        # the crash: the queue is never closed and the last record is only partly written
+        queue.writer.write(queue.RECORD.pack(0, 1000) + b'x' * 10)
+        queue.writer.close()
+
+        queue = shipper.SpillQueue(directory, memory_bytes=0)
+        assert queue.qsize() == 100
+        # spilled again after the restart, into a new segment behind the cut one
+        for item in items(100, 50):
+            queue.put_nowait(item)
+        assert queue.qsize() == 150
+        assert drain(queue) == items(0, 150)
+        assert queue.disk_items == 0 and queue.disk_bytes == 0
+        await asyncio.wait_for(queue.join(), 1)
+        assert [name for name in os.listdir(directory) if name.endswith('.seg')] == []
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(directory))
+
+
+def test_close_and_restart():
+    """
+    close writes the in-flight batches and the items in memory in front of the spilled ones
+    """
+    async def run(directory):
+        queue = shipper.SpillQueue(directory, memory_bytes=80)
+        for item in items(0, 30):
+            queue.put_nowait(item)
+        inflight = {1: [queue.get_nowait() for _ in range(5)]}
+        queue.close(inflight)
+
+        queue = shipper.SpillQueue(directory, memory_bytes=80)
+        assert queue.qsize() == 30
+        assert drain(queue) == items(0, 30)
+        assert shipper.spilled_offsets(queue) == {1: 240}
+        await asyncio.wait_for(queue.join(), 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(directory))
+
+
+if __name__ == '__main__':
+    '''
+    SpillQueue recovery after a crash and after a clean shutdown
+    '''
+    test_crash_recovery()
+    test_close_and_restart()
+    print('ok')